@@ -0,0 +1,247 @@
+"""
+Builds a DB snapshot offline, without a running service.
+
+Rows are read from a CSV, XLSX, JSONL or Parquet file and embedded in large batches by a
+pool of worker processes. Every embedded batch is checkpointed, so an interrupted build
+resumes where it stopped. The result is loaded with `/v1/memory/restore`, which uses the
+stored vectors instead of embedding the rows again.
+
+    python app/build_snapshot.py input.xlsx --db test --text-column Prompt --metadata-column Metadata
+"""
+
+import os, sys
+import csv
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import multiprocessing
+
+import numpy as np
+
+from utils import LoggerInit, Logger, Prefs
+from vectordb.embedder import Embedder
+from vectordb.memory import DB
+from vectordb.models import model_id
+from vectordb.indexer import INDEX_TYPES, REDUCTION_METHODS
+
+
+LoggerInit()
+logger = Logger()
+FORMATS = ("csv", "xlsx", "jsonl", "parquet")
+
+
+def readRows(path: str, fmt: str, text_column: str, metadata_column: str) -> list:
+    """
+    Reads (text, metadata) pairs. Rows without text are skipped.
+    """
+    if fmt == "csv":
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+    elif fmt == "jsonl":
+        with open(path, encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f if line.strip() != ""]
+    else:
+        import pandas as pd
+        df = pd.read_excel(path, header=0) if fmt == "xlsx" else pd.read_parquet(path)
+        df = df.astype(object).where(pd.notnull(df), None)
+        rows = df.to_dict('records')
+
+    records = []
+    for row in rows:
+        text = row.get(text_column)
+        if text is None or str(text) == "":
+            continue
+        records.append((str(text), row.get(metadata_column, '')))
+    if len(records) < len(rows):
+        logger.warning(f"Skipped {len(rows) - len(records)} rows without `{text_column}`")
+    return records
+
+
+# Embedding runs in worker processes, each with its own copy of the model
+_embedder = None
+def initWorker(model_path: str, threads: int) -> None:
+    global _embedder
+    import torch
+    torch.set_num_threads(threads)
+    _embedder = Embedder(model_path)
+
+
+def embedBatch(texts: list) -> np.ndarray:
+    return np.array(_embedder.embed_text(texts), dtype=np.float32)
+
+
+def checkpointDir(path: str, manifest: dict) -> None:
+    """
+    Creates the checkpoint directory, or checks that the one left by an earlier run belongs to the same build.
+    """
+    manifest_path = os.path.join(path, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            if json.load(f) != manifest:
+                raise Exception(f"Checkpoint directory {path} belongs to another build, remove it or pass another --checkpoint-dir.")
+        return
+    os.makedirs(path, exist_ok=True)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+
+def batchPath(path: str, index: int) -> str:
+    return os.path.join(path, f"batch-{index:08d}.npy")
+
+
+def saveBatch(path: str, index: int, embeddings: np.ndarray) -> None:
+    tmp = batchPath(path, index) + ".tmp"
+    with open(tmp, 'wb') as f:
+        np.save(f, embeddings)
+    os.replace(tmp, batchPath(path, index))
+
+
+def embedAll(texts: list, args, checkpoint: str) -> None:
+    """
+    Embeds every batch that has no checkpoint yet and reports the throughput.
+    """
+    batches = [i for i in range((len(texts) + args.batch_size - 1) // args.batch_size) if not os.path.exists(batchPath(checkpoint, i))]
+    total = sum(len(texts[i * args.batch_size:(i + 1) * args.batch_size]) for i in batches)
+    if len(batches) == 0:
+        logger.info("All batches already embedded")
+        return
+    logger.info(f"Embedding {total} rows in {len(batches)} batches, {len(texts) - total} rows resumed from {checkpoint}")
+
+    started = time.perf_counter()
+    done = 0
+    def completed(index: int, embeddings: np.ndarray) -> None:
+        nonlocal done
+        saveBatch(checkpoint, index, embeddings)
+        done += len(embeddings)
+        elapsed = time.perf_counter() - started
+        logger.info(f"{done}/{total} rows, {done / elapsed:.1f} rows/s")
+
+    if args.workers == 0:
+        initWorker(args.model, args.threads or os.cpu_count())
+        for i in batches:
+            completed(i, embedBatch(texts[i * args.batch_size:(i + 1) * args.batch_size]))
+        return
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=initWorker, initargs=(args.model, threads)) as executor:
+        pending = {}
+        queued = iter(batches)
+        while True:
+            # Keep two batches per worker in flight, so texts are not all sent at once
+            for i in queued:
+                pending[executor.submit(embedBatch, texts[i * args.batch_size:(i + 1) * args.batch_size])] = i
+                if len(pending) >= args.workers * 2:
+                    break
+            if len(pending) == 0:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                completed(pending.pop(future), future.result())
+
+
+def buildDB(records: list, args, checkpoint: str) -> DB:
+    batch_count = (len(records) + args.batch_size - 1) // args.batch_size
+    first = np.load(batchPath(checkpoint, 0), mmap_mode='r')
+    reduction = None
+    if args.reduction is not None:
+        reduction = {
+            "method": args.reduction,
+            "dimension": args.reduction_dimension,
+            "train_size": args.pca_train_size or Prefs().getIntPref("pca_train_size") or 1000
+        }
+    dbObj = DB(args.size, first.shape[1], args.index_type, args.rerank_multiplier, reduction, model_id(args.model))
+    dbObj.set_records([{"text": text, "metadata": metadata} for text, metadata in records])
+    for i in range(batch_count):
+        dbObj.vector_index.add_index(np.load(batchPath(checkpoint, i), mmap_mode='r'))
+    if dbObj.vector_index.needs_training():
+        dbObj.vector_index.train()
+    return dbObj
+
+
+def run(args) -> None:
+    started = time.perf_counter()
+    fmt = args.format or os.path.splitext(args.input)[1].lower().lstrip(".")
+    if fmt not in FORMATS:
+        raise Exception(f"Unsupported input format: {fmt}, use --format with one of {', '.join(FORMATS)}")
+    records = readRows(args.input, fmt, args.text_column, args.metadata_column)
+    if len(records) == 0:
+        raise Exception("No rows to embed.")
+    args.size = args.size or max(Prefs().getIntPref("db_size") or 0, len(records))
+    if len(records) > args.size:
+        raise Exception(f"Input has {len(records)} rows, more than the DB size {args.size}.")
+    logger.info(f"Read {len(records)} rows from {args.input} in {time.perf_counter() - started:.1f}s")
+
+    texts = [text for text, _ in records]
+    checkpoint = args.checkpoint_dir or args.output + ".parts"
+    checkpointDir(checkpoint, {
+        "rows": len(texts),
+        "batch_size": args.batch_size,
+        "model": os.path.abspath(args.model),
+        "texts": hashlib.sha1("\0".join(texts).encode('utf-8')).hexdigest()
+    })
+
+    embed_started = time.perf_counter()
+    embedAll(texts, args, checkpoint)
+    embed_elapsed = time.perf_counter() - embed_started
+
+    build_started = time.perf_counter()
+    dbObj = buildDB(records, args, checkpoint)
+    tmp = args.output + ".tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump(
+            {
+                'db': args.db,
+                **dbObj.settings(),
+                'memory': dbObj.memory,
+                'vectors': dbObj.vector_index.get_vectors(),
+                'index_state': dbObj.vector_index.get_state()
+            },
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL
+        )
+    os.replace(tmp, args.output)
+    if not args.keep_checkpoint:
+        shutil.rmtree(checkpoint, ignore_errors=True)
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Wrote {args.output} ({os.path.getsize(args.output)} bytes) with {len(records)} rows: "
+                f"embedding {embed_elapsed:.1f}s, index {time.perf_counter() - build_started:.1f}s, "
+                f"total {elapsed:.1f}s, {len(records) / elapsed:.1f} rows/s")
+
+
+# Setting configurable parameters
+parser = argparse.ArgumentParser(description="Builds a DB snapshot loadable with /v1/memory/restore.")
+parser.add_argument("input", type=str, help="CSV, XLSX, JSONL or Parquet file")
+parser.add_argument("--format", type=str, default=None, choices=FORMATS, help="Input format, from the file extension by default")
+parser.add_argument("--db", type=str, required=True, help="DB name")
+parser.add_argument("--output", type=str, default="", help="Snapshot file, <db>.pkl by default")
+parser.add_argument("--text-column", type=str, default="text")
+parser.add_argument("--metadata-column", type=str, default="metadata")
+parser.add_argument("--model", type=str, default=os.environ.get('MODEL_PATH') or "model", help="Model path, MODEL_PATH by default")
+parser.add_argument("--size", type=int, default=0, help="DB size, at least the number of rows")
+parser.add_argument("--index-type", type=str, default=Prefs().getPref("index_type") or "flat", choices=INDEX_TYPES)
+parser.add_argument("--rerank-multiplier", type=int, default=Prefs().getIntPref("rerank_multiplier") or 4)
+parser.add_argument("--reduction", type=str, default=None, choices=REDUCTION_METHODS)
+parser.add_argument("--reduction-dimension", type=int, default=0)
+parser.add_argument("--pca-train-size", type=int, default=0)
+parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 4), help="Embedding processes, 0 to embed in this process")
+parser.add_argument("--threads", type=int, default=0, help="Torch threads per worker, the cores split across workers by default")
+parser.add_argument("--batch-size", type=int, default=1024, help="Rows per batch and per checkpoint")
+parser.add_argument("--checkpoint-dir", type=str, default="", help="<output>.parts by default")
+parser.add_argument("--keep-checkpoint", action="store_true", default=False)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    args.output = args.output or f"{args.db}.pkl"
+    try:
+        run(args)
+    except Exception as e:
+        logger.error(e)
+        sys.exit(1)
+    sys.exit(0)
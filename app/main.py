@@ -1,8 +1,13 @@
 import os, sys
 import json
+import time
 import uuid
+import asyncio
+import functools
 import argparse
 import uvicorn
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
 
 import warnings
 warnings.filterwarnings('ignore', category=UserWarning, message='TypedStorage is deprecated')
@@ -11,17 +16,18 @@ from dotenv import load_dotenv
 
 from fastapi import FastAPI, Request, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse, Response
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse, PlainTextResponse
 
 from utils import LoggerInit, Logger, Prefs
 from utils.interface import (HealthResponse, InfoResponse, ErrorResponse)
-from vectordb import Memory
+from vectordb import Memory, SnapshotUnavailable, ModelMismatch, Replica, OpLogTruncated, IngestQueue, QueueFull, BatchTooLarge, Profiler, ProfilerBusy, Timings, Scheduler, Overloaded, Compactor
 
 
 
 # Setting Global variables
 load_dotenv()
 timeout_keep_alive = 5  # seconds
+timeout_graceful_shutdown = 5  # seconds, replication streams never complete on their own
 logger = Logger()
 environment = str(os.environ.get('ENVIRONMENT_NAME')).lower()
 debug = os.environ.get('DEBUG')
@@ -39,7 +45,6 @@ else:
         model_path = os.environ.get('MODEL_PATH')
 
 
-served_model = ""
 embedding_dimension = 0
 if not os.path.exists(os.path.join(model_path, "config.json")):
     raise Exception("Model not found.")
@@ -47,6 +52,27 @@ if not os.path.exists(os.path.join(model_path, "config.json")):
 
 # Default Preferences
 default_db_size = Prefs().getIntPref("db_size")
+replication_heartbeat = Prefs().getIntPref("replication_heartbeat") or 5
+worker_threads = Prefs().getIntPref("worker_threads") or 8
+ingest_queue_size = Prefs().getIntPref("ingest_queue_size") or 10000
+ingest_batch_size = Prefs().getIntPref("ingest_batch_size") or 256
+ingest_linger = (Prefs().getIntPref("ingest_linger_ms") or 5) / 1000
+profile_max_seconds = Prefs().getIntPref("profile_max_seconds") or 60
+profile_min_interval_ms = Prefs().getFloatPref("profile_min_interval_ms") or 1
+scheduler_capacities = {
+    "search": Prefs().getIntPref("search_queue_size") or 1000,
+    "add": Prefs().getIntPref("add_queue_size") or 100,
+    "restore": Prefs().getIntPref("restore_queue_size") or 2
+}
+db_concurrency = Prefs().getIntPref("db_concurrency") or 0
+# Additions and restores never take every worker away from searches
+scheduler_concurrency = {
+    "add": Prefs().getIntPref("add_concurrency") or max(worker_threads // 2, 1),
+    "restore": Prefs().getIntPref("restore_concurrency") or 1
+}
+compaction_threshold = Prefs().getFloatPref("compaction_threshold") or 0
+compaction_interval = Prefs().getIntPref("compaction_interval") or 10
+compaction_min_dead = Prefs().getIntPref("compaction_min_dead") or 0
         
 
 # Initialize logger
@@ -67,6 +93,37 @@ async def unhandledExceptionHandler(request: Request, exc: Exception) -> JSONRes
     return JSONResponse(response, status_code=500)
 
 
+# Model and FAISS calls run on a dedicated pool, off the event loop
+executor = ThreadPoolExecutor(max_workers=worker_threads, thread_name_prefix="vectordb")
+async def runBlocking(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+# Searches, additions and restores are admitted by the scheduler, in that order of priority
+async def runScheduled(kind: str, dbs: list, fn, *args, **kwargs):
+    future = scheduler.submit(kind, dbs, functools.partial(fn, *args, **kwargs), timings=kwargs.get("timings"))
+    return await asyncio.wrap_future(future)
+
+
+def overloadedResponse(id: str, e: Overloaded) -> Response:
+    ret = ErrorResponse(request_id=id, code=str(429002), error=str(e)).model_dump()
+    return JSONResponse(ret, status_code=429, headers={"Retry-After": str(e.retry_after)})
+
+
+# Writes are only accepted by the primary
+def readOnlyResponse(id: str) -> Response:
+    ret = ErrorResponse(request_id=id, code=str(403001), error="Writes are not accepted by a read replica").model_dump()
+    return JSONResponse(ret, status_code=403)
+
+
+# Per-stage timings are only collected for requests that ask for them
+def requestTimings(request: Request, request_dict: dict, started: float):
+    enabled = request.headers.get("x-timing", "").lower() in ("1", "true")
+    if 'timing' in request_dict:
+        enabled = bool(request_dict.pop("timing")) or enabled
+    return Timings(started) if enabled else None
+
+
 # Setting configurable parameters
 parser = argparse.ArgumentParser(description="RESTful API server.")
 
@@ -80,6 +137,10 @@ parser.add_argument("--bind", type=str, default="")
 parser.add_argument("--timeout", type=int, default=2000)
 parser.add_argument("--worker-class", type=str, default='uvicorn.workers.UvicornWorker')
 
+# replication parameters
+parser.add_argument("--role", type=str, default='primary', choices=['primary', 'replica'], help="Replication role")
+parser.add_argument("--primary-url", type=str, default='', help="Base URL of the primary, required for replicas")
+
 # fastapi parameters
 parser.add_argument("--allow-credentials",
                             action="store_true",
@@ -101,7 +162,11 @@ parser.add_argument("--allowed-headers",
 
 # Start Vector DB
 vector_store = Memory(model_path=model_path)
-served_model = vector_store.get_model_name()
+profiler = Profiler()
+scheduler = Scheduler(worker_threads, scheduler_capacities, db_concurrency, scheduler_concurrency)
+ingest_queue = IngestQueue(vector_store, ingest_queue_size, ingest_batch_size, ingest_linger, scheduler)
+compactor = Compactor(vector_store, compaction_threshold, compaction_interval, compaction_min_dead)
+replica = None
 
 
 # FastAPI app
@@ -123,6 +188,41 @@ app = FastAPI(title="VectorDB Service",
 app.add_exception_handler(Exception, unhandledExceptionHandler)
 
 
+@app.on_event("startup")
+async def startup() -> None:
+    global replica
+    scheduler.start()
+    compactor.start()
+    if args.role == 'replica':
+        if args.primary_url == '':
+            raise Exception("Replicas require --primary-url.")
+        replica = Replica(vector_store, args.primary_url, read_timeout=replication_heartbeat * 3)
+        replica.start()
+    else:
+        ingest_queue.start()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    if replica is not None:
+        await replica.stop()
+    else:
+        await asyncio.to_thread(ingest_queue.stop)
+    await asyncio.to_thread(scheduler.stop)
+    await asyncio.to_thread(compactor.stop)
+
+
+def replicationStatus() -> dict:
+    if replica is not None:
+        return replica.status()
+    return {
+        "role": "primary",
+        "epoch": vector_store.oplog.epoch,
+        "head_seq": vector_store.oplog.head,
+        "first_seq": vector_store.oplog.first_seq()
+    }
+
+
 # Get Health Check API
 @app.get('/health')
 async def health() -> Response:
@@ -140,19 +240,135 @@ async def info() -> Response:
     dbs = vector_store.list_db()      
     return JSONResponse(
         InfoResponse(
-            models=[served_model],
-            db=dbs
+            models=vector_store.models.names(),
+            dbs=dbs,
+            replication=replicationStatus(),
+            ingest=ingest_queue.status(),
+            memory=vector_store.memory_status(),
+            cache=vector_store.result_cache.status() if vector_store.result_cache is not None else {},
+            scheduler=scheduler.status(),
+            model_memory=vector_store.models.status(),
+            compaction=compactor.status()
         ).model_dump(), status_code=200)
 
 
+@app.get('/v1/replication/status')
+async def replication_status() -> Response:
+    return JSONResponse(replicationStatus(), status_code=200)
+
+
+@app.get('/v1/scheduler/status')
+async def scheduler_status() -> Response:
+    return JSONResponse(scheduler.status())
+
+
+@app.get('/v1/admin/profile')
+async def profile(seconds: float = 10, interval_ms: float = 10) -> Response:
+    """
+    Samples the stacks of every thread for `seconds` and returns them in the collapsed
+    format read by flamegraph.pl and speedscope. `interval_ms` is raised to
+    `profile_min_interval_ms`, so that sampling cannot starve the service.
+    """
+    id = str(uuid.uuid4())
+    if seconds <= 0 or seconds > profile_max_seconds or interval_ms <= 0:
+        ret = ErrorResponse(request_id=id, code=str(422003), error=f"`seconds` must be between 0 and {profile_max_seconds} and `interval_ms` positive").model_dump()
+        return JSONResponse(ret, status_code=422)
+    interval_ms = max(interval_ms, profile_min_interval_ms)
+    try:
+        stacks = await asyncio.to_thread(profiler.profile, seconds, interval_ms / 1000)
+    except ProfilerBusy as e:
+        ret = ErrorResponse(request_id=id, code=str(409001), error=str(e)).model_dump()
+        return JSONResponse(ret, status_code=409)
+    return PlainTextResponse(stacks)
+
+
+@app.get('/v1/replication/stream')
+async def replication_stream(since: int = 0, epoch: str = "") -> Response:
+    """
+    Streams the operation log as newline delimited JSON. Replicas that cannot resume
+    from `since` receive a `reset` followed by a snapshot of every database first.
+    """
+    if replica is not None:
+        ret = ErrorResponse(request_id=str(uuid.uuid4()), code=str(403002), error="Replication stream is served by the primary only").model_dump()
+        return JSONResponse(ret, status_code=403)
+    return StreamingResponse(replicationFeed(since, epoch), media_type='application/x-ndjson')
+
+
+def snapshotLine(db_name: str, fields: dict, missing: Optional[dict] = None) -> Optional[str]:
+    """
+    Returns a DB as a `restore` line updated with `fields`, or `missing` if the DB no longer exists.
+    When `fields` sets the position of the line, the last operation the DB holds is sent as `db_seq`.
+    """
+    op = vector_store.snapshot_db(db_name)
+    if op is None:
+        if missing is None:
+            return None
+        op = missing
+    elif "seq" in fields:
+        op["db_seq"] = op["seq"]
+    op.update(fields)
+    return json.dumps(op, default=str) + "\n"
+
+
+async def snapshotLines(db_name: str, seq: int, fields: dict, missing: Optional[dict] = None):
+    """
+    Reads and serializes a DB off the event loop, with heartbeats while a large one is being read.
+    """
+    task = asyncio.ensure_future(runBlocking(snapshotLine, db_name, fields, missing))
+    while not task.done():
+        done, _ = await asyncio.wait({task}, timeout=replication_heartbeat)
+        if len(done) == 0:
+            yield json.dumps({"seq": seq, "ts": time.time(), "op": "heartbeat", "head": vector_store.oplog.head}) + "\n"
+    line = task.result()
+    if line is not None:
+        yield line
+
+
+async def replicationFeed(since: int, epoch: str):
+    oplog = vector_store.oplog
+    if epoch != oplog.epoch or since > oplog.head or since < oplog.first_seq() - 1:
+        head = oplog.head
+        yield json.dumps({"seq": head, "ts": time.time(), "op": "reset", "epoch": oplog.epoch, "head": head}) + "\n"
+        # One DB at a time
+        for db_name in vector_store.snapshot_names():
+            async for line in snapshotLines(db_name, head, {"snapshot": True, "head": head}):
+                yield line
+        yield json.dumps({"seq": head, "ts": time.time(), "op": "snapshot_end", "epoch": oplog.epoch, "head": head}) + "\n"
+        since = head
+
+    while True:
+        try:
+            ops = oplog.read(since)
+        except OpLogTruncated:
+            return
+        if len(ops) > 0:
+            head = oplog.head
+            for op in ops:
+                if op["op"] == "restore":
+                    # The log only holds a marker: send the DB as it is now, at the position of the marker
+                    marker = {"seq": op["seq"], "ts": op["ts"], "head": head}
+                    async for line in snapshotLines(op["db"], op["seq"] - 1, marker, {"op": "purge", "db": op["db"]}):
+                        yield line
+                    continue
+                yield json.dumps(dict(op, head=head), default=str) + "\n"
+            since = ops[-1]["seq"]
+        elif not await asyncio.to_thread(oplog.wait, since, replication_heartbeat):
+            yield json.dumps({"seq": since, "ts": time.time(), "op": "heartbeat", "head": oplog.head}) + "\n"
+
+
 @app.post('/v1/vector/add')
 async def add_vector(request: Request) -> Response:
     # Reading input request data
+    started = time.perf_counter()
     request_dict = await request.json()
     if 'request_id' in request_dict:
         id = str(request_dict.pop("request_id"))
     else:
         id = str(uuid.uuid4())
+    timings = requestTimings(request, request_dict, started)
+
+    if replica is not None:
+        return readOnlyResponse(id)
         
     if 'db' in request_dict:
         db = str(request_dict.pop("db"))
@@ -161,7 +377,8 @@ async def add_vector(request: Request) -> Response:
         return JSONResponse(ret, status_code=422)
 
     if 'text' in request_dict:
-        text = str(request_dict.pop("text"))
+        text = request_dict.pop("text")
+        text = [str(i) for i in text] if isinstance(text, list) else str(text)
     else:
         ret = ErrorResponse(request_id=id, code=str(422001), error="Required field `text` missing in request").model_dump()
         return JSONResponse(ret, status_code=422)
@@ -171,27 +388,116 @@ async def add_vector(request: Request) -> Response:
     else:
         metadata = ''
 
+    if 'async' in request_dict:
+        write_behind = bool(request_dict.pop("async"))
+    else:
+        write_behind = False
+
+    if timings is not None:
+        timings.record("parse", started)
+
     try:
-        vector_store.add(db_name=db, text=text, metadata=metadata)
+        if write_behind:
+            # Acknowledge right away, the ingestion worker embeds and indexes in batches
+            if not vector_store.has_db(db):
+                raise Exception("Database not found.")
+            sequence = ingest_queue.submit(db_name=db, text=text, metadata=metadata)
+            ret = {
+                "request_id": id,
+                "first_sequence": sequence - (len(text) if isinstance(text, list) else 1) + 1,
+                "sequence": sequence
+            }
+            if timings is not None:
+                ret["timings"] = timings.to_dict()
+            return JSONResponse(ret)
+
+        await runScheduled("add", [db], vector_store.add, db_name=db, text=text, metadata=metadata, timings=timings)
         ret = {
             "request_id": id
         }
+        if timings is not None:
+            ret["timings"] = timings.to_dict()
         return JSONResponse(ret)
         
+    except BatchTooLarge as e:
+        ret = ErrorResponse(request_id=id, code=str(413001), error=str(e)).model_dump()
+        return JSONResponse(ret, status_code=413)
+    except QueueFull as e:
+        ret = ErrorResponse(request_id=id, code=str(429001), error=str(e)).model_dump()
+        return JSONResponse(ret, status_code=429, headers={"Retry-After": "1"})
+    except Overloaded as e:
+        return overloadedResponse(id, e)
     except Exception as e:
         ret = ErrorResponse(request_id=id, code=str(500), error="Something went wrong: " + str(e)).model_dump()
         logger.error(e)
         return JSONResponse(ret, status_code=500)
 
 
+@app.post('/v1/vector/flush')
+async def flush_vector(request: Request) -> Response:
+    """
+    Waits until asynchronous additions up to `sequence` (default: all accepted so far) are searchable,
+    and reports the entries from `from_sequence` (default: `sequence`, or all when it is not given) that failed.
+    """
+    # Reading input request data
+    request_dict = await request.json()
+    if 'request_id' in request_dict:
+        id = str(request_dict.pop("request_id"))
+    else:
+        id = str(uuid.uuid4())
+
+    if 'sequence' in request_dict:
+        sequence = int(request_dict.pop("sequence"))
+        from_sequence = sequence
+    else:
+        sequence = ingest_queue.status()["last_seq"]
+        from_sequence = 1
+
+    if 'from_sequence' in request_dict:
+        from_sequence = int(request_dict.pop("from_sequence"))
+
+    if 'timeout' in request_dict:
+        timeout = float(request_dict.pop("timeout"))
+    else:
+        timeout = 30
+
+    if await ingest_queue.wait(sequence, timeout):
+        failed, errors = ingest_queue.failed_between(from_sequence, sequence)
+        ret = {
+            "request_id": id,
+            "sequence": ingest_queue.status()["committed_seq"],
+            "failed": failed,
+            "errors": errors
+        }
+        return JSONResponse(ret)
+    ret = ErrorResponse(request_id=id, code=str(504001), error=f"Sequence {sequence} not written within {timeout} seconds").model_dump()
+    return JSONResponse(ret, status_code=504)
+
+
+def searchResults(cached_results: list) -> list:
+    results = []
+    for i in cached_results:
+        result = {
+            "text": i['text'],
+            "metadata": i['metadata'],
+            "distance": round(float(i['distance']),2)
+        }
+        if 'db' in i:
+            result["db"] = i['db']
+        results.append(result)
+    return results
+
+
 @app.post('/v1/vector/search')
 async def search_vector(request: Request) -> Response:
     # Reading input request data
+    started = time.perf_counter()
     request_dict = await request.json()
     if 'request_id' in request_dict:
         id = str(request_dict.pop("request_id"))
     else:
         id = str(uuid.uuid4())
+    timings = requestTimings(request, request_dict, started)
 
     if 'db' in request_dict:
         db = str(request_dict.pop("db"))
@@ -210,27 +516,104 @@ async def search_vector(request: Request) -> Response:
     else:
         top_n = 1
 
+    if 'rerank_multiplier' in request_dict:
+        rerank_multiplier = int(request_dict.pop("rerank_multiplier"))
+    else:
+        rerank_multiplier = None
+
+    if timings is not None:
+        timings.record("parse", started)
+
     try:
-        cached_results = vector_store.search(db_name=db, query=text, top_n=top_n)
-        if len(cached_results) > 0:
-            results = []
-            for i in cached_results:
-                results.append({
-                    "text": i['text'],
-                    "metadata": i['metadata'],
-                    "distance": round(float(i['distance']),2)
-                })
-            ret = {
-                "request_id": id,
-                "results": results
-            }
-        else:
-            ret = {
-                "request_id": id,
-                "results": []
-            }
+        cached_results = await runScheduled("search", [db], vector_store.search, db_name=db, query=text, top_n=top_n, rerank_multiplier=rerank_multiplier, timings=timings)
+        response_started = time.perf_counter()
+        ret = {
+            "request_id": id,
+            "results": searchResults(cached_results)
+        }
+        if len(cached_results) > 0 and 'coarse_rank' in cached_results[0]:
+            # Binary indexes report whether the exact re-ranking changed the Hamming order
+            ret["reranked"] = any(i['coarse_rank'] != rank for rank, i in enumerate(cached_results))
+        if timings is not None:
+            timings.record("response", response_started)
+            ret["timings"] = timings.to_dict()
         return JSONResponse(ret)
         
+    except Overloaded as e:
+        return overloadedResponse(id, e)
+    except Exception as e:
+        ret = ErrorResponse(request_id=id, code=str(500), error="Something went wrong: " + str(e)).model_dump()
+        logger.error(e)
+        return JSONResponse(ret, status_code=500)
+
+
+@app.post('/v1/vector/search_many')
+async def search_many_vector(request: Request) -> Response:
+    """
+    Searches several databases with one embedding of `text`. Returns the results per database,
+    or with `merge` the top_n results over all of them, each tagged with its `db`; merged
+    databases must share a model.
+    """
+    # Reading input request data
+    started = time.perf_counter()
+    request_dict = await request.json()
+    if 'request_id' in request_dict:
+        id = str(request_dict.pop("request_id"))
+    else:
+        id = str(uuid.uuid4())
+    timings = requestTimings(request, request_dict, started)
+
+    if 'dbs' in request_dict and isinstance(request_dict["dbs"], list) and len(request_dict["dbs"]) > 0:
+        dbs = [str(i) for i in request_dict.pop("dbs")]
+    else:
+        ret = ErrorResponse(request_id=id, code=str(422001), error="Required field `dbs` missing in request").model_dump()
+        return JSONResponse(ret, status_code=422)
+
+    if 'text' in request_dict:
+        text = str(request_dict.pop("text"))
+    else:
+        ret = ErrorResponse(request_id=id, code=str(422001), error="Required field `text` missing in request").model_dump()
+        return JSONResponse(ret, status_code=422)
+
+    if 'top_n' in request_dict:
+        top_n = request_dict.pop("top_n")
+    else:
+        top_n = 1
+
+    if 'rerank_multiplier' in request_dict:
+        rerank_multiplier = int(request_dict.pop("rerank_multiplier"))
+    else:
+        rerank_multiplier = None
+
+    if 'merge' in request_dict:
+        merge = bool(request_dict.pop("merge"))
+    else:
+        merge = False
+
+    if timings is not None:
+        timings.record("parse", started)
+
+    try:
+        cached_results = await runScheduled("search", dbs, vector_store.search_many, db_names=dbs, query=text, top_n=top_n, rerank_multiplier=rerank_multiplier, merge=merge, timings=timings)
+        response_started = time.perf_counter()
+        if merge:
+            results = searchResults(cached_results)
+        else:
+            results = {db: searchResults(i) for db, i in cached_results.items()}
+        ret = {
+            "request_id": id,
+            "results": results
+        }
+        if timings is not None:
+            timings.record("response", response_started)
+            ret["timings"] = timings.to_dict()
+        return JSONResponse(ret)
+
+    except ModelMismatch as e:
+        ret = ErrorResponse(request_id=id, code=str(422005), error=str(e)).model_dump()
+        return JSONResponse(ret, status_code=422)
+    except Overloaded as e:
+        return overloadedResponse(id, e)
     except Exception as e:
         ret = ErrorResponse(request_id=id, code=str(500), error="Something went wrong: " + str(e)).model_dump()
         logger.error(e)
@@ -245,6 +628,9 @@ async def create_memory(request: Request) -> Response:
         id = str(request_dict.pop("request_id"))
     else:
         id = str(uuid.uuid4())
+
+    if replica is not None:
+        return readOnlyResponse(id)
     
     if 'db' in request_dict:
         db = str(request_dict.pop("db"))
@@ -256,9 +642,35 @@ async def create_memory(request: Request) -> Response:
         size = request_dict.pop("size")
     else:
         size = default_db_size
+
+    if 'index_type' in request_dict:
+        index_type = str(request_dict.pop("index_type"))
+    else:
+        index_type = None
+
+    if 'rerank_multiplier' in request_dict:
+        rerank_multiplier = int(request_dict.pop("rerank_multiplier"))
+    else:
+        rerank_multiplier = None
+
+    if 'reduction' in request_dict:
+        reduction = request_dict.pop("reduction")
+        if not isinstance(reduction, dict):
+            ret = ErrorResponse(request_id=id, code=str(422002), error="Field `reduction` must be an object with `method` and `dimension`").model_dump()
+            return JSONResponse(ret, status_code=422)
+    else:
+        reduction = None
+
+    if 'model' in request_dict:
+        model = str(request_dict.pop("model"))
+        if not vector_store.models.has(model):
+            ret = ErrorResponse(request_id=id, code=str(422004), error=f"Unknown model `{model}`, available models: {', '.join(vector_store.models.names())}").model_dump()
+            return JSONResponse(ret, status_code=422)
+    else:
+        model = None
         
     try:
-        vector_store.create_db(db_name=db, size=size)
+        await runBlocking(vector_store.create_db, db_name=db, size=size, index_type=index_type, rerank_multiplier=rerank_multiplier, reduction=reduction, model=model)
         ret = {
             "request_id": id
         }
@@ -283,11 +695,23 @@ async def backup_memory(request: Request) -> Response:
     else:
         ret = ErrorResponse(request_id=id, code=str(422001), error="Required field `db` missing in request").model_dump()
         return JSONResponse(ret, status_code=422)
+
+    if 'since' in request_dict:
+        since = str(request_dict.pop("since"))
+    else:
+        since = None
     
     try:
-        cache = vector_store.save_db(db_name=db)
-        headers = {'Content-Disposition': 'attachment; filename="memory.pkl"'}
+        cache, snapshot_id = await runBlocking(vector_store.save_db, db_name=db, since=since)
+        filename = "memory.pkl" if since is None else "memory.delta.pkl"
+        headers = {
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'X-Snapshot-Id': snapshot_id
+        }
         return Response(cache, headers=headers, media_type='application/octet-stream')
+    except SnapshotUnavailable as e:
+        ret = ErrorResponse(request_id=id, code=str(409002), error=str(e)).model_dump()
+        return JSONResponse(ret, status_code=409)
     except Exception as e:
         ret = ErrorResponse(request_id=id, code=str(500), error="Something went wrong: " + str(e)).model_dump()
         logger.error(e)
@@ -295,14 +719,19 @@ async def backup_memory(request: Request) -> Response:
     
 
 @app.post('/v1/memory/restore')
-async def restore_memory(cache: bytes = File()) -> Response:
+async def restore_memory(cache: bytes = File(), deltas: List[bytes] = File(default=[])) -> Response:
     id = str(uuid.uuid4())
+    if replica is not None:
+        return readOnlyResponse(id)
+
     try:
-        vector_store.restore_db(memory_file=cache)
+        await runScheduled("restore", [], vector_store.restore_db, memory_file=cache, deltas=deltas)
         ret = {
             "request_id": id
         }
         return JSONResponse(ret)
+    except Overloaded as e:
+        return overloadedResponse(id, e)
     except Exception as e:
         ret = ErrorResponse(request_id=id, code=str(500), error="Something went wrong: " + str(e)).model_dump()
         logger.error(e)
@@ -318,6 +747,9 @@ async def purge_memory(request: Request) -> Response:
     else:
         id = str(uuid.uuid4())
 
+    if replica is not None:
+        return readOnlyResponse(id)
+
     if 'db' in request_dict:
         db = str(request_dict.pop("db"))
     else:
@@ -325,7 +757,7 @@ async def purge_memory(request: Request) -> Response:
         return JSONResponse(ret, status_code=422)
     
     try:
-        vector_store.clean_db(db_name=db, q=100)
+        await runBlocking(vector_store.clean_db, db_name=db, q=100)
         ret = {
             "request_id": id
         }
@@ -373,4 +805,4 @@ if __name__ == "__main__":
         },
     }
 
-    uvicorn.run(app, host=args.host, port=args.port, timeout_keep_alive=timeout_keep_alive, log_config=uvicorn_log_config)
+    uvicorn.run(app, host=args.host, port=args.port, timeout_keep_alive=timeout_keep_alive, timeout_graceful_shutdown=timeout_graceful_shutdown, log_config=uvicorn_log_config)
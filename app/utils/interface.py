@@ -13,6 +13,13 @@ class HealthResponse(BaseModel):
 class InfoResponse(BaseModel):
     models: List[str]
     dbs: List[dict]
+    replication: dict
+    ingest: dict
+    memory: dict
+    cache: dict
+    scheduler: dict
+    model_memory: dict
+    compaction: dict
 
 
 class ErrorResponse(BaseModel):
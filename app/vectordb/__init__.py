@@ -1 +1,8 @@
-from .memory import Memory
+from .memory import Memory, SnapshotUnavailable, ModelMismatch
+from .ingest import IngestQueue, QueueFull, BatchTooLarge
+from .oplog import OpLog, OpLogTruncated
+from .replica import Replica
+from .profiler import Profiler, ProfilerBusy, Timings
+from .scheduler import Scheduler, Overloaded
+from .models import ModelRegistry
+from .compactor import Compactor
\ No newline at end of file
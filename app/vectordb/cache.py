@@ -0,0 +1,86 @@
+"""
+This module provides the ResultCache class, an LRU cache of search results validated
+against the write generation of the database they were computed from.
+"""
+
+# pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals
+
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+def normalize_query(query: str) -> str:
+    """
+    Collapses runs of whitespace and trims the query, so spellings that differ only in
+    whitespace share cached results.
+    """
+    return " ".join(query.split())
+
+
+class ResultCache:
+    """
+    ResultCache maps a search key to the results and the database generation they were
+    computed at. An entry is only served while the database is still at that generation,
+    so a write never lets a stale result through.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+
+    def get(
+        self,
+        key: Hashable,
+        generation: Optional[int]
+    ) -> Any:
+        """
+        Returns the cached results for `key` if they were computed at `generation`, else None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != generation:
+                del self.entries[key]
+                self.stale += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+
+    def put(
+        self,
+        key: Hashable,
+        generation: int,
+        results: Any
+    ) -> None:
+        with self.lock:
+            self.entries[key] = (generation, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def status(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups > 0 else 0.0
+            }
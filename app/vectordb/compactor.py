@@ -0,0 +1,139 @@
+"""
+This module provides the Compactor class that rebuilds databases in the background once
+enough of their entries were evicted.
+"""
+
+# pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals, broad-except
+
+import time
+import threading
+from typing import Optional
+
+from .memory import Memory
+from utils import Logger
+
+
+logger = Logger()
+class Compactor:
+    """
+    Compactor periodically checks the resident databases and compacts, one at a time, those
+    whose tombstoned (evicted) entries reach `threshold` of their index and number at least
+    `min_dead`, or the size of the database if smaller. Compaction runs on its own thread,
+    searches and additions are only held for the final swap.
+    """
+
+    def __init__(
+        self,
+        memory: Memory,
+        threshold: float,
+        interval: float,
+        min_dead: int
+    ):
+        """
+        :param memory: the Memory whose databases are compacted.
+        :param threshold: the ratio of tombstoned entries that triggers a compaction, 0 to disable compaction.
+        :param interval: seconds between two checks.
+        :param min_dead: the minimum number of tombstoned entries worth a compaction.
+        """
+        self.memory = memory
+        self.threshold = threshold
+        self.interval = interval
+        self.min_dead = min_dead
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.current = None
+        self.phase = None
+        self.started = None
+        self.compactions = 0
+        self.reclaimed_bytes = 0
+        self.last: Optional[dict] = None
+
+
+    def start(self) -> None:
+        if self.threshold <= 0:
+            return
+        self.thread = threading.Thread(target=self._run, name="compactor", daemon=True)
+        self.thread.start()
+
+
+    def stop(self, timeout: float = 10) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+    def candidates(self) -> list:
+        """
+        Returns the resident databases due for compaction, the most fragmented first.
+        """
+        with self.memory.lock:
+            items = list(self.memory.db.items())
+        due = []
+        for db_name, dbObj in items:
+            total = len(dbObj.memory)
+            if total > 0 and dbObj.dead >= min(self.min_dead, dbObj.size) and dbObj.dead / total >= self.threshold:
+                due.append((dbObj.dead / total, db_name))
+        return [db_name for _, db_name in sorted(due, reverse=True)]
+
+
+    def _progress(self, phase: str) -> None:
+        with self.lock:
+            self.phase = phase
+
+
+    def compact(self, db_name: str) -> int:
+        """
+        Compacts one database and records the outcome.
+        """
+        with self.lock:
+            self.current = db_name
+            self.phase = None
+            self.started = time.perf_counter()
+        reclaimed = 0
+        error = None
+        try:
+            reclaimed = self.memory.compact_db(db_name, self._progress)
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Failed to compact {db_name}: {e}")
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            if reclaimed > 0:
+                self.compactions += 1
+                self.reclaimed_bytes += reclaimed
+            self.last = {
+                "db": db_name,
+                "reclaimed_bytes": reclaimed,
+                "duration_ms": round(elapsed * 1000, 3),
+                "abandoned": reclaimed == 0 and error is None,
+                "error": error
+            }
+            self.current = None
+            self.phase = None
+        return reclaimed
+
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            for db_name in self.candidates():
+                if self.stopped.is_set():
+                    return
+                self.compact(db_name)
+
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "enabled": self.thread is not None,
+                "threshold": self.threshold,
+                "running": None if self.current is None else {
+                    "db": self.current,
+                    "phase": self.phase,
+                    "elapsed_ms": round((time.perf_counter() - self.started) * 1000, 3)
+                },
+                "compactions": self.compactions,
+                "reclaimed_bytes": self.reclaimed_bytes,
+                "inline_compactions": self.memory.inline_compactions,
+                "last": self.last
+            }
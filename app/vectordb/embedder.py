@@ -5,8 +5,13 @@ This module provides classes for generating text embeddings using various pre-tr
 # pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals
 
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Optional
+import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
+from sentence_transformers.util import batch_to_device
+
+from .profiler import Timings
 
 
 class BaseEmbedder(ABC):
@@ -39,12 +44,32 @@ class Embedder(BaseEmbedder):
             raise TypeError(f"Model not found: {e}")
 
 
-    def embed_text(self, chunks: List[str]) -> List[List[float]]:
+    def embed_text(self, chunks: List[str], timings: Optional[Timings] = None) -> List[List[float]]:
         """
         Converts a list of text chunks into their corresponding embeddings.
 
         :param chunks: a list of strings containing the text chunks to be embedded.
+        :param timings: if given, tokenization and the forward pass are timed separately.
         :return: a list of embeddings, where each embedding is represented as a list of floats.
         """
+        if timings is not None:
+            return self._embed_timed(chunks, timings)
         embeddings = self.model.encode(sentences=chunks, show_progress_bar=False).tolist()
-        return embeddings
\ No newline at end of file
+        return embeddings
+
+
+    def _embed_timed(self, chunks: List[str], timings: Timings, batch_size: int = 32) -> List[List[float]]:
+        """
+        Runs the steps of `SentenceTransformer.encode` one by one so that each can be timed.
+        """
+        embeddings = []
+        for start in range(0, len(chunks), batch_size):
+            with timings.stage("tokenize"):
+                features = self.model.tokenize(chunks[start:start + batch_size])
+            with timings.stage("forward"):
+                features = batch_to_device(features, self.model.device)
+                with torch.no_grad():
+                    embeddings.append(self.model(features)["sentence_embedding"].float().cpu().numpy())
+        if len(embeddings) == 0:
+            return []
+        return np.concatenate(embeddings).tolist()
\ No newline at end of file
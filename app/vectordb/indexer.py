@@ -4,78 +4,287 @@ This module provides the VectorIndex class for performing vector search using va
 
 # pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals
 
-from typing import List, Tuple, Union
+import base64
+from typing import List, Tuple, Union, Optional
 import numpy as np
 import faiss
 from utils import Logger
 
 
 logger = Logger()
+def set_threads(threads: int) -> None:
+    """
+    Sets the number of OpenMP threads used by FAISS. Searches are already run in parallel
+    from the request threads, so a single thread per search avoids oversubscribing the cores.
+    """
+    faiss.omp_set_num_threads(threads)
+
+
+INDEX_TYPES = ("flat", "binary")
+REDUCTION_METHODS = ("pca", "truncate")
+
+
 class VectorIndex:
     """
     A class to perform vector search using different methods (MRPT, Faiss, or scikit-learn).
+
+    With the `binary` index type every vector also gets a 1-bit sign code. Searches scan
+    the codes by Hamming distance first and re-rank `top_n * rerank_multiplier` candidates
+    by exact cosine over the float vectors.
+
+    With a `reduction` the index keeps fewer dimensions than the embeddings: `truncate`
+    keeps the first `dimension` components (Matryoshka-style models), `pca` learns a
+    projection once `train_size` vectors were added. Until then a `pca` index stores full
+    vectors; `train` projects them in place. Queries are projected the same way.
+
+    Evicted vectors are not removed from the FAISS indexes, which would shift every later
+    vector: the oldest `dead` ids are tombstoned and excluded from searches until the
+    index is compacted into an `empty_copy`.
     """
     
-    def __init__(self, dim):
+    def __init__(self, dim, index_type: str = "flat", rerank_multiplier: int = 4, reduction: Optional[dict] = None):
+        if index_type not in INDEX_TYPES:
+            raise Exception(f"Unsupported index type: {index_type}")
+        self.dim = dim
+        self.index_type = index_type
+        self.rerank_multiplier = rerank_multiplier
+        self.reduction = None
+        self.pca = None
+        self.dead = 0
+        if reduction is not None:
+            method = reduction.get("method")
+            dimension = int(reduction.get("dimension", 0))
+            if method not in REDUCTION_METHODS:
+                raise Exception(f"Unsupported reduction method: {method}")
+            if dimension <= 0 or dimension >= dim:
+                raise Exception(f"Reduced dimension must be between 1 and {dim - 1}")
+            self.reduction = {
+                "method": method,
+                "dimension": dimension,
+                "train_size": max(int(reduction.get("train_size") or 0), dimension)
+            }
+        self._build(self.reduction["dimension"] if self.reduction is not None and self.reduction["method"] == "truncate" else dim)
+
+
+    def _build(self, dim: int) -> None:
         self.index = faiss.IndexFlatIP(dim)
+        self.binary_index = None
+        if self.index_type == "binary":
+            self.binary_index = faiss.IndexBinaryFlat(((dim + 7) // 8) * 8)
+
+
+    @staticmethod
+    def _binarize(vectors: np.ndarray) -> np.ndarray:
+        return np.packbits(vectors > 0, axis=1)
+
+
+    def _project(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Maps normalized embeddings to the normalized vectors kept by the index.
+        """
+        faiss.normalize_L2(vectors)
+        if self.reduction is None:
+            return vectors
+        if self.reduction["method"] == "truncate":
+            vectors = np.ascontiguousarray(vectors[:, :self.reduction["dimension"]])
+        elif self.pca is not None:
+            vectors = self.pca.apply(vectors)
+        else:
+            return vectors
+        faiss.normalize_L2(vectors)
+        return vectors
+
+
+    def _add_projected(self, vectors: np.ndarray) -> None:
+        self.index.add(vectors)
+        if self.binary_index is not None:
+            self.binary_index.add(self._binarize(vectors))
 
 
     def add_index(
         self, 
-        query_vector: List[float]
+        query_vector: Union[List[float], np.ndarray]
     ) -> None:
         try:
-            if isinstance(query_vector, list):
-                query_vector = np.array(query_vector).astype(np.float32)
-            
-            query_vector = np.array([query_vector])
-            faiss.normalize_L2(query_vector)
-            self.index.add(query_vector)
+            query_vector = np.array(query_vector, dtype=np.float32)
+            if query_vector.ndim == 1:
+                query_vector = np.array([query_vector])
+            self._add_projected(self._project(query_vector))
             return
         except Exception as e:
             raise Exception(e)
-    
-    
-    def remove_index(
-        self, 
-        index: Union[int, List[int]]
+
+
+    def add_stored(
+        self,
+        vectors: np.ndarray
     ) -> None:
-        try:
-            if isinstance(index, int):
-                index = [index]
-            
-            ids_to_remove = np.array(index, dtype=np.int64)
-            self.index.remove_ids(ids_to_remove)
-            return
-        except Exception as e:
-            raise Exception(e)
+        """
+        Adds vectors previously returned by `get_vectors`, they are already projected.
+        Vectors are copied in chunks so that a memory mapped array is never fully loaded.
+        """
+        for start in range(0, len(vectors), 65536):
+            self._add_projected(np.ascontiguousarray(vectors[start:start + 65536], dtype=np.float32))
+
+
+    def needs_training(self) -> bool:
+        """
+        Returns True once a `pca` index holds enough vectors to learn its projection.
+        """
+        return self.reduction is not None and self.reduction["method"] == "pca" and self.pca is None \
+            and self.index.ntotal - self.dead >= self.reduction["train_size"]
+
+
+    def train(self) -> None:
+        """
+        Learns the PCA projection from the vectors in the index and projects them.
+        """
+        pca = faiss.PCAMatrix(self.dim, self.reduction["dimension"])
+        pca.train(self.get_vectors())
+        self._set_pca(pca)
 
+
+    def _set_pca(self, pca) -> None:
+        # Tombstoned vectors are projected too, so that ids keep matching the records
+        vectors = self.get_vectors(0)
+        self.pca = pca
+        self._build(self.reduction["dimension"])
+        if len(vectors) > 0:
+            vectors = self.pca.apply(vectors)
+            faiss.normalize_L2(vectors)
+            self._add_projected(vectors)
+
+
+    def get_state(self) -> dict:
+        """
+        Returns what, besides the stored vectors, is needed to rebuild the index elsewhere.
+        """
+        if self.pca is None:
+            return {}
+        writer = faiss.VectorIOWriter()
+        faiss.write_VectorTransform(self.pca, writer)
+        return {
+            "pca": base64.b64encode(faiss.vector_to_array(writer.data).tobytes()).decode('ascii')
+        }
+
+
+    def set_state(self, state: dict) -> None:
+        """
+        Applies a state returned by `get_state`, projecting the vectors already in the index.
+        """
+        if state is not None and "pca" in state and self.pca is None:
+            reader = faiss.VectorIOReader()
+            faiss.copy_array_to_vector(np.frombuffer(base64.b64decode(state["pca"]), dtype=np.uint8), reader.data)
+            self._set_pca(faiss.read_VectorTransform(reader))
+    
     
     def search_index(
         self,
         query_vector: List[float],
-        top_n: int
-    ) -> List[Tuple[int, float]]:
+        top_n: int,
+        rerank_multiplier: Optional[int] = None
+    ) -> List[Tuple]:
         """
         Searches for the most similar vectors to the query_vector in the given embeddings.
         :param query_vector: a list of floats representing the query vector.
         :param top_n: the number of most similar vectors to return.
-        :return: a list of indices of the top_n most similar vectors in the embeddings.
+        :param rerank_multiplier: overrides the candidate multiplier of a binary index.
+        :return: a list of (index, similarity) of the top_n most similar vectors in the embeddings.
+        A binary index returns (index, similarity, coarse_rank) where coarse_rank is the position
+        of the vector in the Hamming distance scan.
         
         """
         if isinstance(query_vector, list):
             query_vector = np.array(query_vector).astype(np.float32)
 
         try:
-            if top_n > self.index.ntotal:
-                top_n = self.index.ntotal
+            if top_n > self.index.ntotal - self.dead:
+                top_n = self.index.ntotal - self.dead
                 
-            query_vector = np.array([query_vector])
-            faiss.normalize_L2(query_vector)
-            dis, indices = self.index.search(query_vector, top_n)
+            query_vector = self._project(np.array([query_vector], dtype=np.float32))
+            if self.binary_index is not None:
+                return self._search_binary(query_vector, top_n, rerank_multiplier or self.rerank_multiplier)
+            dis, indices = self.index.search(query_vector, top_n, params=self._live_params())
         except AssertionError as e:
             return []
         except Exception as e:
             raise Exception(f"Faiss search failed: {e}")
         
-        return list(zip(indices[0], dis[0]))
\ No newline at end of file
+        return list(zip(indices[0], dis[0]))
+
+
+    def _live_params(self):
+        """
+        Returns search parameters skipping the tombstoned ids, None if there are none.
+        """
+        if self.dead == 0:
+            return None
+        return faiss.SearchParameters(sel=faiss.IDSelectorRange(self.dead, self.index.ntotal))
+
+
+    def _search_binary(
+        self,
+        query_vector: np.ndarray,
+        top_n: int,
+        rerank_multiplier: int
+    ) -> List[Tuple[int, float, int]]:
+        candidates_count = min(top_n * max(rerank_multiplier, 1), self.binary_index.ntotal - self.dead)
+        _, candidates = self.binary_index.search(self._binarize(query_vector), candidates_count, params=self._live_params())
+        candidates = candidates[0][candidates[0] >= 0]
+        if len(candidates) == 0:
+            return []
+
+        scores = self.index.reconstruct_batch(candidates) @ query_vector[0]
+        order = np.argsort(-scores, kind="stable")[:top_n]
+        return [(candidates[i], scores[i], int(i)) for i in order]
+
+
+    def get_vectors(self, start: Optional[int] = None) -> np.ndarray:
+        """
+        Returns the normalized (and projected) vectors stored in the index as a (n, d) matrix.
+        :param start: the first id to return, by default the first one that is not tombstoned.
+        """
+        start = self.dead if start is None else start
+        if self.index.ntotal <= start:
+            return np.zeros((0, self.index.d), dtype=np.float32)
+        return self.index.reconstruct_n(start, self.index.ntotal - start)
+
+
+    def remove_oldest(self, count: int) -> None:
+        """
+        Tombstones the `count` oldest vectors that are still searchable.
+        """
+        self.dead = min(self.dead + count, self.index.ntotal)
+
+
+    def empty_copy(self) -> 'VectorIndex':
+        """
+        Returns an empty index with the same options and PCA projection, to compact this one into.
+        """
+        index = VectorIndex(self.dim, self.index_type, self.rerank_multiplier, self.reduction)
+        if self.pca is not None:
+            index.pca = self.pca
+            index._build(self.reduction["dimension"])
+        return index
+
+
+    def dead_bytes(self) -> int:
+        """
+        Returns the memory held by tombstoned vectors, reclaimed by compaction.
+        """
+        size = self.dead * self.index.d * 4
+        if self.binary_index is not None:
+            size += self.dead * self.binary_index.code_size
+        return size
+
+
+    def memory_bytes(self) -> int:
+        """
+        Returns an estimate of the memory held by the index.
+        """
+        size = self.index.ntotal * self.index.d * 4
+        if self.binary_index is not None:
+            size += self.binary_index.ntotal * self.binary_index.code_size
+        if self.pca is not None:
+            size += self.pca.d_in * self.pca.d_out * 4
+        return size
\ No newline at end of file
@@ -0,0 +1,262 @@
+"""
+This module provides the IngestQueue class that acknowledges additions right away and
+writes them to Memory in large batches from a background thread.
+"""
+
+# pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals, broad-except
+
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Dict, Union, List, Optional, Tuple
+
+from .memory import Memory
+from .scheduler import Scheduler, Overloaded
+from utils import Logger
+
+
+class QueueFull(Exception):
+    """Raised when the ingestion queue cannot accept more entries."""
+
+
+class BatchTooLarge(Exception):
+    """Raised when a request has more entries than the ingestion queue can ever hold."""
+
+
+FAILURES_RETAINED = 10000   # failed sequence ranges kept for `failures`
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(True)
+
+
+logger = Logger()
+class IngestQueue:
+    """
+    IngestQueue is a bounded write-behind queue in front of `Memory.add`. Every entry gets
+    a sequence number when it is accepted. A single worker drains the queue in order and
+    writes each batch with `Memory.add_many`, which embeds the entries of all databases
+    sharing a model in one forward pass, as an `add` task of the scheduler when there is one. All entries up to the committed sequence number are
+    searchable (or have failed).
+    """
+
+    def __init__(
+        self,
+        memory: Memory,
+        capacity: int,
+        batch_size: int,
+        linger: float,
+        scheduler: Optional[Scheduler] = None
+    ):
+        """
+        :param memory: the Memory entries are written to.
+        :param capacity: the maximum number of entries waiting in the queue.
+        :param batch_size: the maximum number of entries written in one batch.
+        :param linger: seconds the worker waits for a batch to fill up before writing it.
+        :param scheduler: if given, batches are written as `add` tasks of this scheduler.
+        """
+        self.memory = memory
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.linger = linger
+        self.scheduler = scheduler
+        self.entries = deque()
+        self.condition = threading.Condition()
+        self.last_seq = 0
+        self.committed_seq = 0
+        self.failed = 0
+        self.last_error = ""
+        # (first_seq, last_seq, error) of failed entries, oldest first
+        self.failures = deque(maxlen=FAILURES_RETAINED)
+        # (seq, loop, future) of flushes waiting in an event loop
+        self.waiters = []
+        self.stopped = False
+        self.thread = None
+
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._run, name="ingest", daemon=True)
+        self.thread.start()
+
+
+    def stop(self, timeout: float = 10) -> None:
+        """
+        Stops the worker once the entries already accepted are written.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+    def submit(
+        self,
+        db_name: str,
+        text: Union[str, List[str]],
+        metadata=None
+    ) -> int:
+        """
+        Queues texts for addition.
+        :return: the sequence number of the last queued entry.
+        """
+        if isinstance(text, list):
+            texts = text
+            metadatas = metadata if isinstance(metadata, list) and len(metadata) == len(texts) else [metadata] * len(texts)
+        else:
+            texts = [text]
+            metadatas = [metadata]
+
+        if len(texts) > self.capacity:
+            raise BatchTooLarge(f"Request has {len(texts)} texts, more than the ingestion queue holds ({self.capacity}).")
+        with self.condition:
+            if self.stopped:
+                raise QueueFull("Ingestion queue is shutting down.")
+            if len(self.entries) + len(texts) > self.capacity:
+                raise QueueFull("Ingestion queue is full.")
+            for i in range(len(texts)):
+                self.last_seq += 1
+                self.entries.append((self.last_seq, db_name, texts[i], metadatas[i]))
+            self.condition.notify_all()
+            return self.last_seq
+
+
+    async def wait(
+        self,
+        seq: int,
+        timeout: float
+    ) -> bool:
+        """
+        Waits in the running event loop, without holding a thread, until every entry up to
+        `seq` is written or the timeout expires.
+        :return: True if the entries are written.
+        """
+        loop = asyncio.get_running_loop()
+        with self.condition:
+            if self.committed_seq >= seq:
+                return True
+            waiter = (seq, loop, loop.create_future())
+            self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[2], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.condition:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+
+    def failed_between(
+        self,
+        first_seq: int,
+        last_seq: int
+    ) -> Tuple[int, List[str]]:
+        """
+        Returns the number of failed entries with a sequence number from `first_seq` to
+        `last_seq`, and their distinct errors.
+        """
+        count = 0
+        errors = []
+        with self.condition:
+            for first, last, error in self.failures:
+                overlap = min(last, last_seq) - max(first, first_seq) + 1
+                if overlap > 0:
+                    count += overlap
+                    if error not in errors:
+                        errors.append(error)
+        return count, errors
+
+
+    def status(self) -> dict:
+        with self.condition:
+            return {
+                "depth": len(self.entries),
+                "capacity": self.capacity,
+                "last_seq": self.last_seq,
+                "committed_seq": self.committed_seq,
+                "failed": self.failed,
+                "last_error": self.last_error
+            }
+
+
+    def _next_batch(self) -> list:
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.entries) > 0 or self.stopped)
+            if len(self.entries) < self.batch_size and not self.stopped:
+                self.condition.wait_for(lambda: len(self.entries) >= self.batch_size or self.stopped, timeout=self.linger)
+            batch = []
+            while len(self.entries) > 0 and len(batch) < self.batch_size:
+                batch.append(self.entries.popleft())
+            return batch
+
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if len(batch) == 0:
+                return
+
+            groups = {}
+            for seq, db_name, text, metadata in batch:
+                group = groups.setdefault(db_name, ([], [], []))
+                group[0].append(text)
+                group[1].append(metadata)
+                group[2].append(seq)
+            try:
+                errors = self._add({db_name: (texts, metadatas) for db_name, (texts, metadatas, _) in groups.items()})
+            except Exception as e:
+                errors = {db_name: str(e) for db_name in groups}
+            for db_name, error in errors.items():
+                texts, _, seqs = groups[db_name]
+                logger.error(f"Failed to ingest {len(texts)} entries into {db_name}: {error}")
+                with self.condition:
+                    self.failed += len(texts)
+                    self.last_error = error
+                    self._record_failures(seqs, error)
+
+            with self.condition:
+                self.committed_seq = batch[-1][0]
+                self.condition.notify_all()
+                ready = [i for i in self.waiters if i[0] <= self.committed_seq]
+                self.waiters = [i for i in self.waiters if i[0] > self.committed_seq]
+            for _, loop, future in ready:
+                try:
+                    loop.call_soon_threadsafe(_resolve, future)
+                except RuntimeError:
+                    # the loop of the waiting request was closed
+                    pass
+
+
+    def _add(self, entries: Dict[str, Tuple[List[str], list]]) -> Dict[str, str]:
+        """
+        Writes one batch, waiting for room in the `add` queue of the scheduler when it is full.
+        :return: the error of every database whose entries failed.
+        """
+        if self.scheduler is None:
+            return self.memory.add_many(entries)
+        while True:
+            try:
+                future = self.scheduler.submit("add", list(entries), lambda: self.memory.add_many(entries))
+                break
+            except Overloaded as e:
+                if self.scheduler.stopped:
+                    raise
+                time.sleep(min(e.retry_after, 1))
+        return future.result()
+
+
+    def _record_failures(self, seqs: List[int], error: str) -> None:
+        """
+        Records failed sequence numbers as ranges. Requires the condition.
+        """
+        first = last = seqs[0]
+        for seq in seqs[1:]:
+            if seq != last + 1:
+                self.failures.append((first, last, error))
+                first = seq
+            last = seq
+        self.failures.append((first, last, error))
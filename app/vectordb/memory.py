@@ -5,25 +5,166 @@ managing memory entries.
 """
 # pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals
 
-import os, json
+import os, sys, json
+import time
 import pickle
-from typing import List, Dict, Any, Union
+import itertools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from typing import Callable, List, Dict, Any, Union, Optional, Tuple
 
-from .embedder import Embedder
-from .indexer import VectorIndex
-from utils import Logger
+from .models import ModelRegistry
+from .indexer import VectorIndex, set_threads
+from .lock import RWLock
+from .oplog import OpLog, OpLogTruncated, encode_vectors, decode_vectors
+from .spill import SpillStore, SpillEntry
+from .cache import ResultCache, normalize_query
+from .profiler import Timings, stage
+from utils import Logger, Prefs
+
+
+RECORD_OVERHEAD = 240       # bytes, entry dict and list slot
+DB_OVERHEAD = 64 * 1024     # bytes, index and bookkeeping structures
+RESTORE_BATCH = 1024        # texts embedded and indexed at a time when restoring a backup
+
+# Write generations are unique across databases, so a purged and recreated
+# database never reuses the generation of cached results.
+_generations = itertools.count(1)
+
+
+def record_bytes(entry: dict) -> int:
+    """
+    Returns an estimate of the memory held by a record.
+    """
+    return sys.getsizeof(entry["text"]) + len(json.dumps(entry["metadata"], default=str)) + RECORD_OVERHEAD
 
 
 class DB():
-    def __init__(self, size: int, embedding_dimension: int):
+    def __init__(self, size: int, embedding_dimension: int, index_type: str = "flat", rerank_multiplier: int = 4, reduction: Optional[dict] = None, model: Optional[str] = None):
         try:
+            self.model = model
+            # Records and vectors share ids. Evicted records stay in place as the
+            # `dead` oldest entries until the database is compacted.
             self.memory = []
-            self.vector_index = VectorIndex(embedding_dimension)
+            self.dead = 0
+            self.dead_bytes = 0
+            self.vector_index = VectorIndex(embedding_dimension, index_type, rerank_multiplier, reduction)
             self.size = size
+            self.last_seq = 0
+            # Guards memory and vector_index. A DB replaced by create, restore or
+            # purge is marked detached so that callers waiting on its lock retry.
+            self.lock = RWLock()
+            self.detached = False
+            self.record_bytes = 0
+            self.last_access = time.monotonic()
+            self.generation = next(_generations)
         except Exception as e:
             raise Exception(e)
 
 
+    def bump(self) -> None:
+        """
+        Moves the database to a new write generation, invalidating cached search results.
+        """
+        self.generation = next(_generations)
+
+
+    def add_record(self, entry: dict) -> None:
+        self.memory.append(entry)
+        self.record_bytes += record_bytes(entry)
+        self.bump()
+
+
+    def set_records(self, records: List[dict]) -> None:
+        self.memory = records
+        self.dead = 0
+        self.dead_bytes = 0
+        self.record_bytes = sum(record_bytes(i) for i in records)
+        self.bump()
+
+
+    def drop_records(self, count: int) -> None:
+        """
+        Tombstones the `count` oldest live records.
+        """
+        count = min(count, len(self.memory) - self.dead)
+        dropped = sum(record_bytes(i) for i in self.memory[self.dead:self.dead + count])
+        self.record_bytes -= dropped
+        self.dead_bytes += dropped
+        self.dead += count
+        self.bump()
+
+
+    def count(self) -> int:
+        """
+        Returns the number of live records.
+        """
+        return len(self.memory) - self.dead
+
+
+    def live_records(self) -> List[dict]:
+        return self.memory[self.dead:]
+
+
+    def replace_contents(self, records: List[dict], vector_index: VectorIndex, dead: int) -> None:
+        """
+        Swaps in compacted records and index, holding the same live entries. Requires the write lock.
+        """
+        self.memory = records
+        self.vector_index = vector_index
+        self.dead = dead
+        self.dead_bytes = sum(record_bytes(i) for i in records[:dead])
+
+
+    def compact(self) -> int:
+        """
+        Rebuilds the index and records without the tombstoned entries. Requires the write lock.
+        :return: the bytes reclaimed.
+        """
+        before = self.memory_bytes()
+        vector_index = self.vector_index.empty_copy()
+        vector_index.add_stored(self.vector_index.get_vectors())
+        self.replace_contents(self.live_records(), vector_index, 0)
+        return before - self.memory_bytes()
+
+
+    def memory_bytes(self) -> int:
+        """
+        Returns an estimate of the memory held by the database: vectors, records and index overhead.
+        """
+        return self.vector_index.memory_bytes() + self.record_bytes + self.dead_bytes + DB_OVERHEAD
+
+
+    def reclaimable_bytes(self) -> int:
+        """
+        Returns the memory held by tombstoned records and vectors, freed by compaction.
+        """
+        return self.vector_index.dead_bytes() + self.dead_bytes
+
+
+    def settings(self) -> dict:
+        """
+        Returns the options the database was created with.
+        """
+        return {
+            "size": self.size,
+            "index_type": self.vector_index.index_type,
+            "rerank_multiplier": self.vector_index.rerank_multiplier,
+            "reduction": self.vector_index.reduction,
+            "model": self.model
+        }
+
+
+class SnapshotUnavailable(Exception):
+    """Raised when the changes since a snapshot cannot be produced and a full backup is needed."""
+
+
+class ModelMismatch(Exception):
+    """Raised when results of databases using different models would be merged."""
+
+
 logger = Logger()
 class Memory:
     """
@@ -33,13 +174,35 @@ class Memory:
     
     def __init__(self, model_path: str):
         self.db: Dict[str, DB] = {}
+        self.spilled: Dict[str, SpillEntry] = {}
+        self.lock = threading.Lock()
+        self.spill_lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        # Serializes swaps, so that they are logged in the order they are applied. `lock`
+        # is never held while waiting for the lock of a database.
+        self.swap_lock = threading.Lock()
+        self.spill_store = SpillStore(Prefs().getPref("spill_dir") or "/tmp/vectordb")
+        self.memory_budget = (Prefs().getIntPref("memory_budget_mb") or 0) * 1024 * 1024
+        self.spill_count = 0
+        self.reload_count = 0
+        self.inline_compactions = 0
+        result_cache_size = Prefs().getIntPref("result_cache_size")
+        self.result_cache = ResultCache(result_cache_size) if result_cache_size else None
+        self.search_pool = ThreadPoolExecutor(max_workers=Prefs().getIntPref("worker_threads") or 8, thread_name_prefix="search")
+        self.oplog = OpLog(Prefs().getIntPref("oplog_size") or 100000)
+        set_threads(Prefs().getIntPref("faiss_threads") or 1)
+        self.index_type = Prefs().getPref("index_type") or "flat"
+        self.rerank_multiplier = Prefs().getIntPref("rerank_multiplier") or 4
+        self.pca_train_size = Prefs().getIntPref("pca_train_size") or 1000
         if os.path.exists(os.path.join(model_path, "config.json")):
-            self.embedder = Embedder(model_path)
-            model_config = os.path.join(model_path, 'config.json')
-            with open(model_config) as f:
-                conf = json.load(f)
-                self.embedding_dimension = conf['hidden_size']
-                self.model_name = conf['_name_or_path']
+            self.models = ModelRegistry(
+                model_path,
+                Prefs().getPref("model_dir") or os.environ.get('MODEL_DIR') or "",
+                (Prefs().getIntPref("model_memory_mb") or 0) * 1024 * 1024
+            )
+            # The default model is loaded right away, other models on first use
+            self.models.get(None)
+            self.embedding_dimension = self.models.dimension(None)
         else:
             raise TypeError("Model not found.")
         
@@ -49,22 +212,311 @@ class Memory:
         Returns a list of all the databases in memory.
         """
         dbs = []
-        for i in self.db:
+        with self.lock:
+            items = list(self.db.items())
+            spilled = list(self.spilled.items())
+        for name, dbObj in items:
+            db_info = {}
+            db_info["name"] = name
+            db_info["size"] = dbObj.size
+            db_info["index_type"] = dbObj.vector_index.index_type
+            db_info["dimension"] = dbObj.vector_index.index.d
+            db_info["model"] = dbObj.model
+            db_info["record_count"] = dbObj.count()
+            db_info["dead_count"] = dbObj.dead
+            db_info["reclaimable_bytes"] = dbObj.reclaimable_bytes()
+            db_info["resident"] = True
+            db_info["memory_bytes"] = dbObj.memory_bytes()
+            dbs.append(db_info)
+        for name, entry in spilled:
             db_info = {}
-            db_info["name"] = i
-            db_info["size"] = self.db[i].size
-            db_info["record_count"] = len(self.db[i].memory)
+            db_info["name"] = name
+            db_info["size"] = entry.settings["size"]
+            db_info["index_type"] = entry.settings["index_type"]
+            db_info["model"] = entry.settings.get("model") or self.models.default
+            db_info["record_count"] = entry.record_count
+            db_info["resident"] = False
+            db_info["memory_bytes"] = entry.memory_bytes
             dbs.append(db_info)
         return dbs
+
+
+    def memory_status(self) -> dict:
+        """
+        Returns the memory accounting of resident and spilled databases.
+        """
+        with self.lock:
+            items = list(self.db.values())
+            spilled = list(self.spilled.values())
+        return {
+            "budget_bytes": self.memory_budget,
+            "resident_bytes": sum(i.memory_bytes() for i in items),
+            "spilled_bytes": sum(i.memory_bytes for i in spilled),
+            "resident_count": len(items),
+            "spilled_count": len(spilled),
+            "spills": self.spill_count,
+            "reloads": self.reload_count
+        }
+
+
+    def has_db(
+        self,
+        db_name: str
+    ) -> bool:
+        with self.lock:
+            return db_name in self.db or db_name in self.spilled
+
+
+    def _generation(
+        self,
+        db_name: str
+    ) -> Optional[int]:
+        """
+        Returns the write generation of a resident or spilled database, None if it does not exist.
+        """
+        with self.lock:
+            if db_name in self.db:
+                return self.db[db_name].generation
+            if db_name in self.spilled:
+                return self.spilled[db_name].generation
+        return None
+
+
+    def _db_model(
+        self,
+        db_name: str
+    ) -> Optional[str]:
+        """
+        Returns the model of a resident or spilled database, None if it does not exist.
+        """
+        with self.lock:
+            if db_name in self.db:
+                return self.db[db_name].model
+            if db_name in self.spilled:
+                return self.models.resolve(self.spilled[db_name].settings.get("model"))
+        return None
+
+
+    @contextmanager
+    def _locked(
+        self,
+        db_name: str,
+        write: bool = False
+    ):
+        """
+        Looks up a database and holds its read (or write) lock for the duration of the block.
+        """
+        while True:
+            with self.lock:
+                dbObj = self.db.get(db_name)
+                if dbObj is None and db_name not in self.spilled:
+                    raise Exception("Database not found.")
+            if dbObj is None:
+                self._reload(db_name)
+                continue
+            with (dbObj.lock.write() if write else dbObj.lock.read()):
+                if dbObj.detached:
+                    continue
+                dbObj.last_access = time.monotonic()
+                yield dbObj
+                return
+
+
+    def _build_db(
+        self,
+        export: dict,
+        vectors: np.ndarray
+    ) -> DB:
+        """
+        Builds a database from the output of `_export_db` and its stored vectors.
+        """
+        dbObj = self._new_db(export)
+        dbObj.set_records(export["memory"])
+        dbObj.vector_index.set_state(export.get("index_state"))
+        dbObj.vector_index.add_stored(vectors)
+        return dbObj
+
+
+    def _enforce_budget(
+        self,
+        keep: Optional[str] = None
+    ) -> None:
+        """
+        Spills the least recently used databases to disk while the resident ones exceed the
+        memory budget. `keep` is never spilled, it is the database the caller is using.
+        """
+        if self.memory_budget <= 0 or not self.spill_lock.acquire(blocking=False):
+            return
+        try:
+            while True:
+                with self.lock:
+                    items = list(self.db.items())
+                if sum(dbObj.memory_bytes() for _, dbObj in items) <= self.memory_budget:
+                    return
+                candidates = [i for i in items if i[0] != keep and not i[1].detached]
+                if len(candidates) == 0:
+                    return
+                db_name, dbObj = min(candidates, key=lambda i: i[1].last_access)
+                if not self._spill(db_name, dbObj):
+                    return
+        finally:
+            self.spill_lock.release()
+
+
+    def _spill(
+        self,
+        db_name: str,
+        dbObj: DB
+    ) -> bool:
+        """
+        Writes a database to disk and evicts it. Searches keep running while it is written;
+        the eviction is abandoned if the database changed in the meantime.
+        """
+        with dbObj.lock.read():
+            if dbObj.detached:
+                return False
+            last_seq = dbObj.last_seq
+            generation = dbObj.generation
+            memory_bytes = dbObj.memory_bytes()
+            export = {
+                **dbObj.settings(),
+                "memory": dbObj.live_records(),
+                "index_state": dbObj.vector_index.get_state()
+            }
+            vectors = dbObj.vector_index.get_vectors()
+        entry = self.spill_store.write(export, vectors, memory_bytes, last_seq, generation)
+
+        with dbObj.lock.write():
+            spill = dbObj.last_seq == last_seq and not dbObj.detached
+            if spill:
+                dbObj.detached = True
+        if spill:
+            with self.lock:
+                # A database that is not detached is still the one registered under its name
+                if self.db.get(db_name) is dbObj:
+                    del self.db[db_name]
+                    self.spilled[db_name] = entry
+                    self.spill_count += 1
+                    logger.info(f"Spilled {db_name} to disk, {memory_bytes} bytes")
+                    return True
+        self.spill_store.remove(entry)
+        return False
+
+
+    def _reload(
+        self,
+        db_name: str
+    ) -> None:
+        """
+        Loads a spilled database back into memory.
+        """
+        with self.reload_lock:
+            with self.lock:
+                entry = self.spilled.get(db_name)
+            if entry is None:
+                return
+            try:
+                export, vectors = self.spill_store.read(entry)
+                dbObj = self._build_db(export, vectors)
+                dbObj.last_seq = entry.last_seq
+                dbObj.generation = entry.generation
+            except Exception:
+                with self.lock:
+                    if self.spilled.get(db_name) is not entry:
+                        # replaced or purged while loading
+                        return
+                raise
+            with self.lock:
+                if self.spilled.get(db_name) is not entry:
+                    return
+                del self.spilled[db_name]
+                self.db[db_name] = dbObj
+                self.reload_count += 1
+            self.spill_store.remove(entry)
+            logger.info(f"Reloaded {db_name} from disk")
+        self._enforce_budget(keep=db_name)
+
+
+    def _swap(
+        self,
+        db_name: str,
+        dbObj: Optional[DB],
+        op: Optional[str] = None,
+        **payload
+    ) -> None:
+        """
+        Swaps in a new database (or removes it when `dbObj` is None) and logs the operation
+        when `op` is given. The previous database is detached under its write lock before the
+        swap is logged, so every write to it is logged first and none can land on it after.
+        Lookups of other databases are not held up while its readers drain.
+        """
+        with self.swap_lock:
+            while True:
+                with self.lock:
+                    old = self.db.get(db_name)
+                if old is not None:
+                    with old.lock.write():
+                        old.detached = True
+                with self.lock:
+                    if self.db.get(db_name) is not old:
+                        # reloaded from disk meanwhile, detach that one too
+                        continue
+                    spilled = self.spilled.pop(db_name, None)
+                    if dbObj is None:
+                        self.db.pop(db_name, None)
+                    else:
+                        self.db[db_name] = dbObj
+                    if op is not None:
+                        seq = self.oplog.append(op, db_name, **payload)
+                        if dbObj is not None:
+                            dbObj.last_seq = seq
+                    break
+        if spilled is not None:
+            self.spill_store.remove(spilled)
+        if dbObj is not None:
+            self._enforce_budget(keep=db_name)
     
         
+    def _new_db(
+        self,
+        settings: dict
+    ) -> DB:
+        """
+        Builds an empty database from the options returned by `DB.settings`.
+        """
+        reduction = settings.get("reduction")
+        if reduction is not None and reduction.get("method") == "pca" and not reduction.get("train_size"):
+            reduction = dict(reduction, train_size=self.pca_train_size)
+        model = self.models.resolve(settings.get("model"))
+        return DB(
+            settings["size"],
+            self.models.dimension(model),
+            settings.get("index_type") or self.index_type,
+            settings.get("rerank_multiplier") or self.rerank_multiplier,
+            reduction,
+            model
+        )
+
+
     def create_db(
         self,
         db_name: str,
-        size: int
+        size: int,
+        index_type: Optional[str] = None,
+        rerank_multiplier: Optional[int] = None,
+        reduction: Optional[dict] = None,
+        model: Optional[str] = None
     ) -> None:   
-        dbObj = DB(size, self.embedding_dimension)
-        self.db[db_name] = dbObj
+        """
+        Creates an empty database, replacing any existing one with the same name.
+        :param index_type: `flat` or `binary` (sign-quantized coarse search with float re-ranking).
+        :param rerank_multiplier: for binary indexes, the number of candidates re-ranked per result.
+        :param reduction: keeps reduced-dimension vectors, e.g. {"method": "pca", "dimension": 128, "train_size": 1000}
+        or {"method": "truncate", "dimension": 128}.
+        :param model: the model embedding its texts, one of `ModelRegistry.names`. (default: the default model)
+        """
+        dbObj = self._new_db({"size": size, "index_type": index_type, "rerank_multiplier": rerank_multiplier, "reduction": reduction, "model": model})
+        self._swap(db_name, dbObj, "create", **dbObj.settings())
         
     
     def clean_db(
@@ -76,129 +528,666 @@ class Memory:
         Clears the memory of earlier added entries
         """
         if q == 100:
-            del self.db[db_name]
+            if not self.has_db(db_name):
+                raise Exception("Database not found.")
+            self._swap(db_name, None, "purge")
         elif q > 0 and q < 100:
-            new_start_index = int((self.index_counter * q) / 100)
-            index_to_remove = list(range(0, new_start_index-1, 1))
-            self.db[db_name].vector_index.remove_index(index_to_remove)
-            self.db[db_name].memory = self.db[db_name].memory[new_start_index:]
+            with self._locked(db_name, write=True) as dbObj:
+                self._evict_logged(db_name, dbObj, int((dbObj.count() * q) / 100))
+
+
+    def _evict_logged(
+        self,
+        db_name: str,
+        dbObj: DB,
+        count: int
+    ) -> None:
+        """
+        Evicts the `count` oldest entries and logs the operation. Requires the write lock.
+        """
+        if count > 0:
+            self._evict(dbObj, count)
+            dbObj.last_seq = self.oplog.append("evict", db_name, count=count)
+
+
+    def _train_logged(
+        self,
+        db_name: str,
+        dbObj: DB
+    ) -> None:
+        """
+        Learns the projection of a reduced database once it holds enough vectors and logs
+        it, so that replicas apply the same projection. Requires the write lock.
+        """
+        if dbObj.vector_index.needs_training():
+            dbObj.vector_index.train()
+            dbObj.bump()
+            dbObj.last_seq = self.oplog.append("reduce", db_name, index_state=dbObj.vector_index.get_state())
+
+
+    def _evict(
+        self,
+        dbObj: DB,
+        count: int
+    ) -> None:
+        """
+        Removes the `count` oldest entries from the database. Tombstones are left to the
+        background compaction, unless they outnumber the size of the database: then it is
+        compacted right away, so that it holds at most twice its size when the compaction
+        is disabled or lags behind.
+        """
+        dbObj.vector_index.remove_oldest(count)
+        dbObj.drop_records(count)
+        if dbObj.dead > dbObj.size:
+            reclaimed = dbObj.compact()
+            self.inline_compactions += 1
+            logger.info(f"Compacted a database on eviction, {reclaimed} bytes reclaimed")
+
+
+    def compact_db(
+        self,
+        db_name: str,
+        progress: Optional[Callable[[str], None]] = None
+    ) -> int:
+        """
+        Rebuilds the index and records of a resident database without its evicted entries.
+        The copy is built without holding the database lock, so searches and additions keep
+        using the current index; entries added or evicted meanwhile are carried over before the
+        new index is swapped in under the write lock. The compaction is abandoned if the
+        database was replaced, spilled or projected in the meantime.
+        :param progress: called with the name of each phase as it starts.
+        :return: the bytes reclaimed, 0 if the compaction was abandoned.
+        """
+        progress = progress or (lambda phase: None)
+        with self.lock:
+            dbObj = self.db.get(db_name)
+        if dbObj is None:
+            return 0
+
+        progress("copy")
+        with dbObj.lock.read():
+            if dbObj.detached or dbObj.dead == 0:
+                return 0
+            old_index = dbObj.vector_index
+            base_total = len(dbObj.memory)
+            base_dead = dbObj.dead
+            records = dbObj.live_records()
+            vectors = old_index.get_vectors()
+
+        progress("build")
+        new_index = old_index.empty_copy()
+        new_index.add_stored(vectors)
+        del vectors
+
+        progress("swap")
+        with dbObj.lock.write():
+            if dbObj.detached or dbObj.vector_index is not old_index or old_index.pca is not new_index.pca:
+                return 0
+            before = dbObj.memory_bytes()
+            records.extend(dbObj.memory[base_total:])
+            new_index.add_stored(old_index.get_vectors(base_total))
+            dead = dbObj.dead - base_dead
+            new_index.remove_oldest(dead)
+            dbObj.replace_contents(records, new_index, dead)
+            reclaimed = before - dbObj.memory_bytes()
+        logger.info(f"Compacted {db_name}, {base_dead} entries removed, {reclaimed} bytes reclaimed")
+        return reclaimed
+
+
+    def _snapshot_id(
+        self,
+        dbObj: DB
+    ) -> str:
+        """
+        Identifies the state of a database: the epoch of the operation log and the last operation applied.
+        """
+        return f"{self.oplog.epoch}:{dbObj.last_seq}"
 
 
     def save_db(
         self,
-        db_name: str
-    ) -> bytes:
+        db_name: str,
+        since: Optional[str] = None
+    ) -> Tuple[bytes, str]:
         """
         Saves the contents of the memory to file.
+        :param since: the `snapshot_id` of an earlier backup. If given, only the operations applied
+        to the database after that backup are saved, read from the operation log.
+        :return: a full backup, or a delta carrying its `base` snapshot and the operations in `from_seq` < seq <= `to_seq`,
+        and the `snapshot_id` (also stored in the file) later deltas can be based on.
         """
-        if db_name in self.db:        
-            data = pickle.dumps(
+        with self._locked(db_name) as dbObj:
+            snapshot_id = self._snapshot_id(dbObj)
+            if since is None:
+                return pickle.dumps(
+                    {
+                        'db': db_name, 
+                        'size': dbObj.size, 
+                        'index_type': dbObj.vector_index.index_type,
+                        'rerank_multiplier': dbObj.vector_index.rerank_multiplier,
+                        'reduction': dbObj.vector_index.reduction,
+                        'model': dbObj.model,
+                        'memory': dbObj.live_records(),
+                        'snapshot_id': snapshot_id
+                    }
+                ), snapshot_id
+            ops = self._ops_since(db_name, dbObj, since)
+            return pickle.dumps(
                 {
-                    'db': db_name, 
-                    'size': self.db[db_name].size, 
-                    'memory': self.db[db_name].memory
+                    'db': db_name,
+                    'base': since,
+                    'snapshot_id': snapshot_id,
+                    'from_seq': int(since.rpartition(":")[2]),
+                    'to_seq': dbObj.last_seq,
+                    'ops': ops
                 }
-            )
-            return data
-        else:
-            raise Exception("Database not found.")
+            ), snapshot_id
+
+
+    def _ops_since(
+        self,
+        db_name: str,
+        dbObj: DB,
+        since: str
+    ) -> List[dict]:
+        """
+        Returns the logged operations applied to a database after the snapshot `since`.
+        Requires the read lock, so that no operation is logged for the database meanwhile.
+        """
+        epoch, _, seq = since.rpartition(":")
+        if epoch != self.oplog.epoch or not seq.isdigit():
+            raise SnapshotUnavailable(f"Snapshot {since} was not taken by this instance.")
+        seq = int(seq)
+        if seq > dbObj.last_seq or dbObj.last_seq > self.oplog.head:
+            raise SnapshotUnavailable(f"Snapshot {since} is not in the operation log of this instance.")
+
+        ops = []
+        try:
+            while seq < dbObj.last_seq:
+                entries = self.oplog.read(seq)
+                if len(entries) == 0:
+                    break
+                for entry in entries:
+                    if entry["seq"] > dbObj.last_seq:
+                        break
+                    if entry["db"] == db_name:
+                        if entry["op"] not in ("add", "evict", "reduce"):
+                            raise SnapshotUnavailable(f"Database was replaced ({entry['op']}) after snapshot {since}.")
+                        ops.append(entry)
+                seq = entries[-1]["seq"]
+        except OpLogTruncated as e:
+            raise SnapshotUnavailable(f"Operations after snapshot {since} are no longer retained.") from e
+        return ops
         
         
     def restore_db(
         self, 
-        memory_file: bytes
+        memory_file: bytes,
+        deltas: Optional[List[bytes]] = None
     ) -> None:
+        """
+        Restores a database from a full backup, followed by a chain of deltas applied in order.
+        Every delta must be based on the snapshot the previous file ends at.
+        """
         try:
             load = pickle.loads(memory_file)
+            if 'ops' in load:
+                raise Exception("The first file must be a full backup.")
             db_name = load['db']
-            size = load['size']
             record_count = len(load['memory'])
 
-            self.db[db_name] = DB(size, self.embedding_dimension)
-            self.db[db_name].memory = load['memory']
-            for i in range(record_count):
-                self.db[db_name].vector_index.add_index(self.embedder.embed_text(self.db[db_name].memory[i]["text"]))
+            if 'vectors' in load:
+                # Snapshots written by build_snapshot.py carry their (projected) vectors
+                vectors = np.asarray(load['vectors'], dtype=np.float32)
+                dbObj = self._new_db(load)
+                dbObj.vector_index.set_state(load.get('index_state'))
+                if vectors.shape != (record_count, dbObj.vector_index.index.d):
+                    raise Exception(f"Snapshot vectors have shape {vectors.shape}, expected ({record_count}, {dbObj.vector_index.index.d}).")
+                dbObj.set_records(load['memory'])
+                dbObj.vector_index.add_stored(vectors)
+            else:
+                dbObj = self._new_db(load)
+                dbObj.set_records(load['memory'])
+                # Embedded in chunks, the embeddings of a whole DB as Python lists would not fit
+                embedder = self.models.get(dbObj.model)
+                for start in range(0, record_count, RESTORE_BATCH):
+                    dbObj.vector_index.add_index(embedder.embed_text([i["text"] for i in dbObj.memory[start:start + RESTORE_BATCH]]))
+
+            snapshot_id = load.get('snapshot_id')
+            for delta_file in deltas or []:
+                delta = pickle.loads(delta_file)
+                if 'ops' not in delta or delta['db'] != db_name or snapshot_id is None or delta['base'] != snapshot_id:
+                    raise Exception(f"Delta {delta.get('snapshot_id')} does not follow snapshot {snapshot_id} of {db_name}.")
+                for op in delta['ops']:
+                    if op["op"] != "reduce" and dbObj.vector_index.needs_training():
+                        dbObj.vector_index.train()
+                    self._apply_op(dbObj, op)
+                snapshot_id = delta['snapshot_id']
+
+            if dbObj.vector_index.needs_training():
+                dbObj.vector_index.train()
+            # Logged without its content, the replication stream reads the DB when it gets there
+            self._swap(db_name, dbObj, "restore", **dbObj.settings())
         except Exception as e:
             raise Exception(f"Failed to load memory file: {e}")
-        
-        
-    def get_model_name(self) -> str:
-        return self.model_name
 
 
+    def _export_db(
+        self,
+        dbObj: DB
+    ) -> dict:
+        """
+        Returns the full content of a database, vectors included, as a JSON serializable dict.
+        """
+        return {
+            **dbObj.settings(),
+            "memory": dbObj.live_records(),
+            "vectors": encode_vectors(dbObj.vector_index.get_vectors()),
+            "index_state": dbObj.vector_index.get_state()
+        }
+
+
+    def snapshot_names(self) -> List[str]:
+        """
+        Returns the names of the resident and spilled databases, to snapshot one at a time
+        with `snapshot_db`.
+        """
+        with self.lock:
+            return list(self.db.keys()) + list(self.spilled.keys())
+
+
+    def snapshot_db(
+        self,
+        db_name: str
+    ) -> Optional[dict]:
+        """
+        Returns a `restore` operation for a resident or spilled database, without reloading
+        the latter, or None if the database no longer exists. The sequence number of the
+        operation is the last one applied to that database, so that replaying the operation
+        log from before the snapshot skips what it already contains.
+        """
+        while True:
+            with self.lock:
+                dbObj = self.db.get(db_name)
+                entry = self.spilled.get(db_name)
+            op = {
+                "op": "restore",
+                "db": db_name
+            }
+            if dbObj is not None:
+                with dbObj.lock.read():
+                    if dbObj.detached:
+                        continue
+                    op["seq"] = dbObj.last_seq
+                    op.update(self._export_db(dbObj))
+                return op
+            if entry is None:
+                return None
+            try:
+                export, vectors = self.spill_store.read(entry)
+            except Exception:
+                with self.lock:
+                    if self.spilled.get(db_name) is entry:
+                        raise
+                # reloaded or replaced while reading
+                continue
+            op["seq"] = entry.last_seq
+            op.update(export)
+            op["vectors"] = encode_vectors(vectors)
+            return op
+
+
+    def apply(
+        self,
+        op: dict
+    ) -> None:
+        """
+        Applies an operation read from the operation log of another instance.
+        Operations carry their vectors, so nothing is re-embedded.
+        :param op: an operation as produced by OpLog or `snapshot`.
+        """
+        kind = op["op"]
+        if kind == "reset":
+            with self.swap_lock:
+                with self.lock:
+                    dbs = list(self.db.values())
+                for dbObj in dbs:
+                    with dbObj.lock.write():
+                        dbObj.detached = True
+                with self.lock:
+                    self.db = {}
+                    spilled = list(self.spilled.values())
+                    self.spilled = {}
+            for entry in spilled:
+                self.spill_store.remove(entry)
+            return
+
+        db_name = op["db"]
+        with self.lock:
+            current = self.db.get(db_name)
+            entry = self.spilled.get(db_name)
+        if current is not None and op["seq"] <= current.last_seq:
+            return
+        if entry is not None and op["seq"] <= entry.last_seq:
+            return
+        if kind == "purge":
+            self._swap(db_name, None)
+            return
+        if kind == "create" or kind == "restore":
+            dbObj = self._new_db(op)
+            if kind == "restore":
+                dbObj.set_records(op["memory"])
+                dbObj.vector_index.set_state(op.get("index_state"))
+                dbObj.vector_index.add_stored(decode_vectors(op["vectors"], dbObj.vector_index.index.d))
+            # A restore read after the operation was logged also holds the later ones
+            dbObj.last_seq = op.get("db_seq", op["seq"])
+            self._swap(db_name, dbObj)
+            return
+
+        with self._locked(db_name, write=True) as dbObj:
+            if op["seq"] <= dbObj.last_seq:
+                return
+            self._apply_op(dbObj, op)
+            dbObj.last_seq = op["seq"]
+        self._enforce_budget(keep=db_name)
+
+
+    def _apply_op(
+        self,
+        dbObj: DB,
+        op: dict
+    ) -> None:
+        """
+        Applies a logged `add`, `evict` or `reduce` operation to a database. Requires the write lock
+        unless the database is not visible yet.
+        """
+        kind = op["op"]
+        if kind == "add":
+            dbObj.add_record({
+                "text": op["text"],
+                "metadata": op["metadata"]
+            })
+            dbObj.vector_index.add_index(decode_vectors(op["vector"], dbObj.vector_index.dim))
+        elif kind == "evict":
+            self._evict(dbObj, op["count"])
+        elif kind == "reduce":
+            dbObj.vector_index.set_state(op["index_state"])
+            dbObj.bump()
+        else:
+            raise Exception(f"Unknown operation: {kind}")
+        
+        
     def add(
         self,
         db_name: str,
-        text: str,
-        metadata: Union[List, List[dict], dict, str, None] = None
+        text: Union[str, List[str]],
+        metadata: Union[List, List[dict], dict, str, None] = None,
+        timings: Optional[Timings] = None
     ) -> None:
         """
         Saves the given texts and metadata to memory.
         :param texts: a string or a list of strings containing the texts to be saved.
         :param metadata: a dictionary or a list of dictionaries containing the metadata associated with the texts.
+        :param timings: if given, records the time spent embedding and indexing.
         """
         try:
-            if db_name not in self.db:
+            if isinstance(text, list):
+                texts = text
+                metadatas = metadata if isinstance(metadata, list) and len(metadata) == len(texts) else [metadata] * len(texts)
+            else:
+                texts = [text]
+                metadatas = [metadata]
+            if len(texts) == 0:
+                return
+
+            model = self._db_model(db_name)
+            if model is None:
                 raise Exception("Database not found.")
-            
-            if len(self.db[db_name].memory) >= self.db[db_name].size:
-                self.clean(q=20)
-                
-            embedding = self.embedder.embed_text(text)
-            entry = {
-                "text": text,
-                "metadata": metadata
-            }
-            self.db[db_name].memory.append(entry)
-            self.db[db_name].vector_index.add_index(embedding)
+
+            # A single forward pass for the whole batch, outside of the lock
+            embeddings = np.array(self.models.get(model).embed_text(texts, timings), dtype=np.float32)
+            self._add_embedded(db_name, texts, metadatas, embeddings, model, timings)
         except Exception as e:
             raise Exception(e)
 
 
+    def add_many(
+        self,
+        entries: Dict[str, Tuple[List[str], list]]
+    ) -> Dict[str, str]:
+        """
+        Saves texts to several databases. The texts of all the databases sharing a model are
+        embedded in one forward pass, then indexed database by database.
+        :param entries: the texts and their metadata (lists of the same length) per database.
+        :return: the error of every database whose texts were not saved.
+        """
+        errors = {}
+        db_names = {}
+        for db_name in entries:
+            model = self._db_model(db_name)
+            if model is None:
+                errors[db_name] = "Database not found."
+            else:
+                db_names.setdefault(model, []).append(db_name)
+
+        for model, names in db_names.items():
+            try:
+                embeddings = np.array(self.models.get(model).embed_text([text for db_name in names for text in entries[db_name][0]]), dtype=np.float32)
+            except Exception as e:
+                errors.update({db_name: str(e) for db_name in names})
+                continue
+            start = 0
+            for db_name in names:
+                texts, metadatas = entries[db_name]
+                try:
+                    self._add_embedded(db_name, texts, metadatas, embeddings[start:start + len(texts)], model)
+                except Exception as e:
+                    errors[db_name] = str(e)
+                start += len(texts)
+        return errors
+
+
+    def _add_embedded(
+        self,
+        db_name: str,
+        texts: List[str],
+        metadatas: list,
+        embeddings: np.ndarray,
+        model: str,
+        timings: Optional[Timings] = None
+    ) -> None:
+        """
+        Indexes texts already embedded with `model`, evicting the oldest entries of a full database.
+        """
+        with self._locked(db_name, write=True) as dbObj, stage(timings, "index"):
+            if dbObj.model != model:
+                raise Exception("Database was replaced with another model.")
+            for i in range(len(texts)):
+                if dbObj.count() >= dbObj.size:
+                    # At least one entry, so that a DB smaller than 5 entries stays within its size
+                    self._evict_logged(db_name, dbObj, max(1, int((dbObj.count() * 20) / 100)))
+                dbObj.add_record({
+                    "text": texts[i],
+                    "metadata": metadatas[i]
+                })
+                dbObj.vector_index.add_index(embeddings[i])
+                dbObj.last_seq = self.oplog.append("add", db_name, text=texts[i], metadata=metadatas[i], vector=encode_vectors(embeddings[i:i+1]))
+                self._train_logged(db_name, dbObj)
+        with stage(timings, "budget"):
+            self._enforce_budget(keep=db_name)
+
+
+    def _search_db(
+        self,
+        db_name: str,
+        query_embedding,
+        top_n: int,
+        unique: bool,
+        rerank_multiplier: Optional[int],
+        model: str,
+        timings: Optional[Timings] = None
+    ):
+        """
+        Searches one database with a query embedding computed by `model`.
+        :return: the generation the database was searched at and the results.
+        """
+        with self._locked(db_name) as dbObj:
+            if dbObj.model != model:
+                raise Exception("Database was replaced with another model.")
+            generation = dbObj.generation
+            with stage(timings, "index"):
+                indices = dbObj.vector_index.search_index(query_embedding, top_n, rerank_multiplier)
+            if unique:
+                unique_indices = []
+                seen_text_indices = set()  # Change the variable name
+                for i in indices:
+                    text_index = dbObj.memory[i[0]][
+                        "text_index"
+                    ]  # Use text_index instead of metadata_index
+                    if (
+                        text_index not in seen_text_indices
+                    ):  # Use seen_text_indices instead of seen_meta_indices
+                        unique_indices.append(i)
+                        seen_text_indices.add(
+                            text_index
+                        )  # Use seen_text_indices instead of seen_meta_indices
+                indices = unique_indices
+
+            results = []
+            for i in indices:
+                result = {
+                    "text": dbObj.memory[i[0]]["text"],
+                    "metadata": dbObj.memory[i[0]]["metadata"],
+                    "distance": i[1]
+                }
+                if len(i) > 2:
+                    result["coarse_rank"] = i[2]
+                results.append(result)
+        return generation, results
+
+
     def search(
         self, 
         db_name: str,
         query: str, 
         top_n: int = 1, 
-        unique: bool = False
+        unique: bool = False,
+        rerank_multiplier: Optional[int] = None,
+        timings: Optional[Timings] = None
     ) -> List[Dict[str, Any]]:
         """
         Searches for the most similar chunks to the given query in memory.
         :param query: a string containing the query text.
         :param top_n: the number of most similar chunks to return. (default: 5)
         :param unique: chunks are filtered out to unique texts (default: False)
+        :param rerank_multiplier: overrides the candidate multiplier of a binary index.
+        :param timings: if given, records the time spent in each stage of the search.
         :return: a list of dictionaries containing the top_n most similar chunks and their associated metadata.
+        Results of a binary index also carry the `coarse_rank` they had before re-ranking.
+        Results are cached until the next write to the database.
         """
-        if db_name not in self.db:
+        generation = self._generation(db_name)
+        model = self._db_model(db_name)
+        if generation is None or model is None:
             raise Exception("Database not found.")
 
+        cache_key = None
+        if isinstance(query, str):
+            query = normalize_query(query)
+            if self.result_cache is not None:
+                cache_key = self._cache_key(db_name, query, top_n, unique, rerank_multiplier)
+                with stage(timings, "cache"):
+                    results = self.result_cache.get(cache_key, generation)
+                if results is not None:
+                    return [dict(i) for i in results]
+
+        embedder = self.models.get(model)
         if isinstance(query, list):
-            query_embedding = self.embedder.embed_text(query)
+            query_embedding = embedder.embed_text(query, timings)
         else:
-            query_embedding = self.embedder.embed_text([query])[0]
+            query_embedding = embedder.embed_text([query], timings)[0]
 
-        indices = self.db[db_name].vector_index.search_index(query_embedding, top_n)
-        if unique:
-            unique_indices = []
-            seen_text_indices = set()  # Change the variable name
-            for i in indices:
-                text_index = self.db[db_name].memory[i[0]][
-                    "text_index"
-                ]  # Use text_index instead of metadata_index
-                if (
-                    text_index not in seen_text_indices
-                ):  # Use seen_text_indices instead of seen_meta_indices
-                    unique_indices.append(i)
-                    seen_text_indices.add(
-                        text_index
-                    )  # Use seen_text_indices instead of seen_meta_indices
-            indices = unique_indices
-
-        results = []
-        for i in indices:
-            results.append({
-                "text": self.db[db_name].memory[i[0]]["text"],
-                "metadata": self.db[db_name].memory[i[0]]["metadata"],
-                "distance": i[1]
-            })
+        generation, results = self._search_db(db_name, query_embedding, top_n, unique, rerank_multiplier, model, timings)
+        if cache_key is not None:
+            self.result_cache.put(cache_key, generation, [dict(i) for i in results])
         return results
+
+
+    @staticmethod
+    def _cache_key(
+        db_name: str,
+        query: str,
+        top_n: int,
+        unique: bool,
+        rerank_multiplier: Optional[int]
+    ) -> tuple:
+        """
+        Returns the result cache key of a search, `query` being normalized with `normalize_query`.
+        """
+        return (db_name, query, top_n, unique, rerank_multiplier)
+
+
+    def search_many(
+        self,
+        db_names: List[str],
+        query: str,
+        top_n: int = 1,
+        unique: bool = False,
+        rerank_multiplier: Optional[int] = None,
+        merge: bool = False,
+        timings: Optional[Timings] = None
+    ) -> Union[Dict[str, List[Dict[str, Any]]], List[Dict[str, Any]]]:
+        """
+        Searches several databases for the same query. The query is embedded once per model and
+        the databases are searched concurrently.
+        :param db_names: the databases to search.
+        :param merge: return a single list of the top_n results over all databases instead of the results per database.
+        The databases must then share a model, since distances of different models are not comparable.
+        :return: a dictionary of the results (as returned by `search`) per database, or if `merge`
+        is set, one list sorted by distance where every result also carries its source `db`.
+        """
+        db_names = list(dict.fromkeys(db_names))
+        query = normalize_query(query)
+        generations = {}
+        models = {}
+        for db_name in db_names:
+            generations[db_name] = self._generation(db_name)
+            models[db_name] = self._db_model(db_name)
+            if generations[db_name] is None or models[db_name] is None:
+                raise Exception(f"Database not found: {db_name}")
+        if merge and len(set(models.values())) > 1:
+            raise ModelMismatch("Databases using different models cannot be merged: " + ", ".join(f"{db_name} ({model})" for db_name, model in models.items()))
+
+        ret = {}
+        pending = db_names
+        if self.result_cache is not None:
+            pending = []
+            with stage(timings, "cache"):
+                for db_name in db_names:
+                    results = self.result_cache.get(self._cache_key(db_name, query, top_n, unique, rerank_multiplier), generations[db_name])
+                    if results is None:
+                        pending.append(db_name)
+                    else:
+                        ret[db_name] = [dict(i) for i in results]
+
+        if len(pending) > 0:
+            query_embeddings = {}
+            for model in dict.fromkeys(models[db_name] for db_name in pending):
+                query_embeddings[model] = self.models.get(model).embed_text([query], timings)[0]
+            def search_db(db_name):
+                return self._search_db(db_name, query_embeddings[models[db_name]], top_n, unique, rerank_multiplier, models[db_name])
+            with stage(timings, "index"):
+                if len(pending) == 1:
+                    searched = [search_db(pending[0])]
+                else:
+                    searched = list(self.search_pool.map(search_db, pending))
+            for db_name, (generation, results) in zip(pending, searched):
+                if self.result_cache is not None:
+                    self.result_cache.put(self._cache_key(db_name, query, top_n, unique, rerank_multiplier), generation, [dict(i) for i in results])
+                ret[db_name] = results
+
+        if not merge:
+            return {db_name: ret[db_name] for db_name in db_names}
+        merged = [dict(result, db=db_name) for db_name in db_names for result in ret[db_name]]
+        merged.sort(key=lambda i: i["distance"], reverse=True)
+        return merged[:top_n]
@@ -0,0 +1,195 @@
+"""
+This module provides the ModelRegistry class that loads embedding models on first use
+and unloads the least recently used ones to stay within a memory budget.
+"""
+
+# pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals
+
+import os
+import json
+import time
+import threading
+from typing import Dict, List, Optional
+
+from .embedder import Embedder
+from utils import Logger
+
+
+WEIGHT_EXTENSIONS = (".safetensors", ".bin", ".pt", ".onnx")
+
+
+def model_id(path: str) -> str:
+    """
+    Returns the name a model is identified by in database settings and backups: the
+    `_name_or_path` of its `config.json`, which does not depend on where it is installed.
+    Falls back to the directory name.
+    """
+    with open(os.path.join(path, "config.json")) as f:
+        config = json.load(f)
+    return config.get("_name_or_path") or os.path.basename(os.path.normpath(path))
+
+
+def model_bytes(path: str) -> int:
+    """
+    Estimates the memory held by a loaded model from the size of its weight files.
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(WEIGHT_EXTENSIONS):
+                size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+class _LoadedModel:
+
+    def __init__(self, embedder: Embedder, memory_bytes: int):
+        self.embedder = embedder
+        self.memory_bytes = memory_bytes
+        self.last_used = time.monotonic()
+
+
+logger = Logger()
+class ModelRegistry:
+    """
+    ModelRegistry serves the default model and every model directory found under
+    `model_dir`. A model is identified by its `model_id` and can also be referred to
+    by its directory name. All models run in this process and share
+    its torch runtime. A model is loaded on first use; when the loaded models exceed
+    `budget` bytes the least recently used ones are unloaded (requests still holding
+    an unloaded model finish with it).
+    """
+
+    def __init__(
+        self,
+        default_path: str,
+        model_dir: str = "",
+        budget: int = 0
+    ):
+        """
+        :param default_path: the model used by databases created without a model.
+        :param model_dir: a directory of model directories, each with a `config.json`.
+        :param budget: bytes the loaded models may hold, 0 for no limit.
+        """
+        self.default = model_id(default_path)
+        self.paths = {self.default: default_path}
+        self.aliases = {os.path.basename(os.path.normpath(default_path)): self.default}
+        if model_dir and os.path.isdir(model_dir):
+            for name in sorted(os.listdir(model_dir)):
+                path = os.path.join(model_dir, name)
+                if not os.path.exists(os.path.join(path, "config.json")):
+                    continue
+                if os.path.realpath(path) == os.path.realpath(default_path):
+                    continue
+                model = model_id(path)
+                if model in self.paths:
+                    logger.warning(f"Model {path} has the same name as {self.paths[model]}, serving it as {name}")
+                    model = name
+                if model not in self.paths:
+                    self.paths[model] = path
+                    self.aliases.setdefault(name, model)
+        self.budget = budget
+        self.loaded: Dict[str, _LoadedModel] = {}
+        self.configs = {}
+        self.lock = threading.Lock()
+        self.load_locks = {name: threading.Lock() for name in self.paths}
+        self.load_count = 0
+        self.unload_count = 0
+
+
+    def names(self) -> List[str]:
+        return list(self.paths.keys())
+
+
+    def has(self, name: str) -> bool:
+        return name in self.paths or name in self.aliases
+
+
+    def resolve(self, name: Optional[str]) -> str:
+        """
+        Returns the name of the model to use for `name`, a model name or directory name,
+        the default model if None.
+        """
+        if name is None or name == "":
+            return self.default
+        if name in self.paths:
+            return name
+        if name in self.aliases:
+            return self.aliases[name]
+        raise Exception(f"Model not found: {name}")
+
+
+    def config(self, name: str) -> dict:
+        """
+        Returns the `config.json` of a model without loading it.
+        """
+        name = self.resolve(name)
+        if name not in self.configs:
+            with open(os.path.join(self.paths[name], "config.json")) as f:
+                self.configs[name] = json.load(f)
+        return self.configs[name]
+
+
+    def dimension(self, name: Optional[str]) -> int:
+        return self.config(name)["hidden_size"]
+
+
+    def get(self, name: Optional[str]) -> Embedder:
+        """
+        Returns the embedder of a model, loading it if needed.
+        """
+        name = self.resolve(name)
+        with self.lock:
+            model = self.loaded.get(name)
+            if model is not None:
+                model.last_used = time.monotonic()
+                return model.embedder
+
+        with self.load_locks[name]:
+            with self.lock:
+                model = self.loaded.get(name)
+            if model is None:
+                started = time.perf_counter()
+                model = _LoadedModel(Embedder(self.paths[name]), model_bytes(self.paths[name]))
+                logger.info(f"Loaded model {name} in {time.perf_counter() - started:.1f}s, {model.memory_bytes} bytes")
+                with self.lock:
+                    self.loaded[name] = model
+                    self.load_count += 1
+                    self._enforce_budget(keep=name)
+            model.last_used = time.monotonic()
+            return model.embedder
+
+
+    def _enforce_budget(self, keep: str) -> None:
+        """
+        Unloads least recently used models other than `keep` until the budget is met. Requires the lock.
+        """
+        if self.budget <= 0:
+            return
+        while sum(i.memory_bytes for i in self.loaded.values()) > self.budget:
+            candidates = [(model.last_used, name) for name, model in self.loaded.items() if name != keep]
+            if len(candidates) == 0:
+                return
+            _, name = min(candidates)
+            del self.loaded[name]
+            self.unload_count += 1
+            logger.info(f"Unloaded model {name}")
+
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "default": self.default,
+                "budget_bytes": self.budget,
+                "loaded": [
+                    {
+                        "name": name,
+                        "memory_bytes": model.memory_bytes,
+                        "idle_seconds": round(now - model.last_used, 1)
+                    }
+                    for name, model in self.loaded.items()
+                ],
+                "loads": self.load_count,
+                "unloads": self.unload_count
+            }
@@ -0,0 +1,118 @@
+"""
+This module provides the OpLog class, a bounded in-memory log of the write operations
+applied to Memory, used to feed read replicas.
+"""
+
+# pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals
+
+import time
+import uuid
+import base64
+import threading
+from collections import deque
+from itertools import islice
+from typing import List
+import numpy as np
+
+
+def encode_vectors(vectors: np.ndarray) -> str:
+    """
+    Packs a matrix of vectors into a base64 string of little-endian float32 values.
+    """
+    return base64.b64encode(np.ascontiguousarray(vectors, dtype='<f4').tobytes()).decode('ascii')
+
+
+def decode_vectors(data: str, dim: int) -> np.ndarray:
+    """
+    Unpacks a string produced by `encode_vectors` into a (n, dim) float32 matrix.
+    """
+    return np.frombuffer(base64.b64decode(data), dtype='<f4').astype(np.float32).reshape(-1, dim)
+
+
+class OpLogTruncated(Exception):
+    """Raised when the requested position is no longer retained in the log."""
+
+
+class OpLog:
+    """
+    OpLog keeps the most recent write operations (create, add, evict, reduce, purge, restore)
+    together with the vectors they carry. A restore is only logged with the database settings,
+    its content is read from the database when it is streamed. Every entry gets a monotonically increasing
+    sequence number so that replicas can tail the log from any retained position.
+    """
+
+    def __init__(self, size: int):
+        self.epoch = uuid.uuid4().hex
+        self.entries = deque(maxlen=size)
+        self.head = 0
+        self.condition = threading.Condition()
+
+
+    def append(
+        self,
+        op: str,
+        db_name: str,
+        **payload
+    ) -> int:
+        """
+        Appends an operation to the log.
+        :param op: the operation name.
+        :param db_name: the database the operation applies to.
+        :param payload: operation specific fields, they must be JSON serializable.
+        :return: the sequence number assigned to the operation.
+        """
+        with self.condition:
+            self.head += 1
+            entry = {
+                "seq": self.head,
+                "ts": time.time(),
+                "op": op,
+                "db": db_name
+            }
+            entry.update(payload)
+            self.entries.append(entry)
+            self.condition.notify_all()
+            return self.head
+
+
+    def first_seq(self) -> int:
+        """
+        Returns the sequence number of the oldest retained operation.
+        """
+        with self.condition:
+            if len(self.entries) > 0:
+                return self.entries[0]["seq"]
+            return self.head + 1
+
+
+    def read(
+        self,
+        since: int,
+        limit: int = 1000
+    ) -> List[dict]:
+        """
+        Returns the operations with a sequence number greater than `since`.
+        :param since: the last sequence number already seen by the caller.
+        :param limit: the maximum number of operations to return.
+        :return: a list of operations in sequence order.
+        """
+        with self.condition:
+            if since >= self.head:
+                return []
+            if len(self.entries) == 0 or since < self.entries[0]["seq"] - 1:
+                raise OpLogTruncated(f"Sequence {since} is no longer retained.")
+            start = since - self.entries[0]["seq"] + 1
+            return list(islice(self.entries, start, start + limit))
+
+
+    def wait(
+        self,
+        since: int,
+        timeout: float
+    ) -> bool:
+        """
+        Blocks until an operation newer than `since` is appended or the timeout expires.
+        :return: True if new operations are available.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.head > since, timeout=timeout)
@@ -0,0 +1,121 @@
+"""
+This module provides the Timings class that breaks a request down into stages and the
+Profiler class that samples the stacks of every thread in the process.
+"""
+
+# pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals
+
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+
+_no_stage = nullcontext()
+
+
+class Timings:
+    """
+    Timings accumulates the wall-clock time spent in named stages of a request, in milliseconds.
+    """
+
+    def __init__(self, started: Optional[float] = None):
+        """
+        :param started: the `time.perf_counter()` the request started at, defaults to now.
+        """
+        self.started = time.perf_counter() if started is None else started
+        self.stages = {}
+
+
+    def record(self, name: str, start: float) -> None:
+        """
+        Adds the time elapsed since `start` (a `time.perf_counter()` value) to stage `name`.
+        """
+        self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+
+    def to_dict(self) -> dict:
+        """
+        Returns the stages and the `total` time since the Timings was created.
+        """
+        ret = {name: round(elapsed, 3) for name, elapsed in self.stages.items()}
+        ret["total"] = round((time.perf_counter() - self.started) * 1000, 3)
+        return ret
+
+
+def stage(timings: Optional[Timings], name: str):
+    """
+    Returns a context manager timing `name` in `timings`, or a shared no-op one if timing is off.
+    """
+    if timings is None:
+        return _no_stage
+    return timings.stage(name)
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+class Profiler:
+    """
+    Profiler is a sampling profiler for the live process. While a profile runs, the calling
+    thread wakes up every `interval` seconds and records the stack of every other thread.
+    Stacks are returned in the collapsed format read by flamegraph.pl and speedscope: one
+    line per distinct stack, frames from the root separated by `;`, followed by the number
+    of samples. Nothing runs between profiles.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+    def profile(
+        self,
+        duration: float,
+        interval: float
+    ) -> str:
+        """
+        Samples all threads for `duration` seconds.
+        :param duration: seconds to sample for.
+        :param interval: seconds between two samples.
+        :return: the collapsed stacks, one `frame;frame;... count` line per distinct stack.
+        """
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running.")
+        try:
+            own_id = threading.get_ident()
+            samples = Counter()
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():  # pylint: disable = protected-access
+                    if thread_id == own_id:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._frame_name(frame))
+                        frame = frame.f_back
+                    stack.append(names.get(thread_id, str(thread_id)))
+                    samples[";".join(reversed(stack))] += 1
+                time.sleep(interval)
+            return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+        finally:
+            self.lock.release()
@@ -0,0 +1,131 @@
+"""
+This module provides the Replica class that keeps a local Memory in sync with a primary
+instance by tailing its operation log stream.
+"""
+
+# pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals, broad-except
+
+import json
+import time
+import asyncio
+import urllib.request
+from typing import Optional
+
+from .memory import Memory
+from utils import Logger
+
+
+logger = Logger()
+class Replica:
+    """
+    Replica follows `/v1/replication/stream` on the primary and applies every operation
+    to the local Memory. Network reads and operations run in worker threads, in order.
+    """
+
+    def __init__(
+        self,
+        memory: Memory,
+        primary_url: str,
+        reconnect_interval: float = 5,
+        read_timeout: float = 30
+    ):
+        self.memory = memory
+        self.primary_url = primary_url.rstrip('/')
+        self.reconnect_interval = reconnect_interval
+        self.read_timeout = read_timeout
+        self.connected = False
+        self.epoch = ""
+        self.applied_seq = 0
+        self.applied_ts = 0.0
+        self.primary_seq = 0
+        self.last_contact = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+
+    def start(self) -> None:
+        """
+        Starts following the primary in the background of the running event loop.
+        """
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.follow()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Replication stream from {self.primary_url} interrupted: {e}")
+            self.connected = False
+            await asyncio.sleep(self.reconnect_interval)
+
+
+    async def follow(self) -> None:
+        """
+        Opens the stream from the last applied sequence number and applies operations
+        until the connection drops. The primary answers with a fresh snapshot when it
+        cannot resume from that position, e.g. after it restarted with a new epoch: a
+        `reset`, one `restore` per database and a closing `snapshot_end`.
+        """
+        url = f"{self.primary_url}/v1/replication/stream?since={self.applied_seq}&epoch={self.epoch}"
+        response = await asyncio.to_thread(urllib.request.urlopen, url, timeout=self.read_timeout)
+        try:
+            self.connected = True
+            logger.info(f"Following {self.primary_url} from sequence {self.applied_seq}")
+            while True:
+                line = await asyncio.to_thread(response.readline)
+                if not line:
+                    return
+                op = json.loads(line)
+                self.last_contact = time.time()
+                if op["op"] == "heartbeat":
+                    self.primary_seq = max(self.primary_seq, op["head"])
+                    continue
+
+                if op["op"] == "snapshot_end":
+                    # Only a complete snapshot moves the replica to the new epoch; a stream
+                    # interrupted before this line resumes with another full snapshot
+                    self.epoch = op["epoch"]
+                    self.applied_seq = op["seq"]
+                    self.applied_ts = op.get("ts", self.last_contact)
+                    logger.info(f"Loaded snapshot of {self.primary_url} at sequence {op['seq']}")
+                    continue
+
+                await asyncio.to_thread(self.memory.apply, op)
+                if op["op"] == "reset":
+                    self.epoch = ""
+                    self.applied_seq = 0
+                    self.primary_seq = op["head"]
+                else:
+                    self.primary_seq = max(self.primary_seq, op.get("head", 0))
+                if op["op"] != "reset" and not op.get("snapshot", False):
+                    self.applied_seq = op["seq"]
+                    self.applied_ts = op.get("ts", self.last_contact)
+        finally:
+            response.close()
+
+
+    def status(self) -> dict:
+        lag_ops = max(self.primary_seq - self.applied_seq, 0)
+        lag_seconds = 0.0
+        if lag_ops > 0 and self.applied_ts > 0:
+            lag_seconds = round(time.time() - self.applied_ts, 3)
+        return {
+            "role": "replica",
+            "primary": self.primary_url,
+            "connected": self.connected,
+            "applied_seq": self.applied_seq,
+            "primary_seq": self.primary_seq,
+            "lag_ops": lag_ops,
+            "lag_seconds": lag_seconds
+        }
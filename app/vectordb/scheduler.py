@@ -0,0 +1,207 @@
+"""
+This module provides the Scheduler class that admits embedding work into bounded
+priority queues and runs it on a fixed set of worker threads.
+"""
+
+# pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals, broad-except
+
+import math
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+from .profiler import Timings
+
+
+class Overloaded(Exception):
+    """Raised when the queue of a priority class is full."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Task:
+
+    def __init__(self, fn: Callable, dbs: List[str], timings: Optional[Timings]):
+        self.fn = fn
+        self.dbs = dbs
+        self.timings = timings
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class Scheduler:
+    """
+    Scheduler keeps one bounded FIFO queue per priority class. Workers always take the
+    oldest task of the most important class whose databases are below the per-database
+    concurrency limit, so a burst of additions to one database neither delays searches
+    nor occupies every worker. Classes can also be capped in how many of their tasks run
+    at once, which keeps workers free for the classes above them. A task is rejected with
+    `Overloaded` as soon as its queue is full instead of waiting behind it.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        capacities: Dict[str, int],
+        db_concurrency: int,
+        concurrency: Optional[Dict[str, int]] = None
+    ):
+        """
+        :param workers: the number of worker threads.
+        :param capacities: the queue size of each priority class, most important first.
+        :param db_concurrency: the maximum number of tasks running on one database at a time, 0 for no limit.
+        :param concurrency: the maximum number of tasks of a priority class running at a time, missing or 0 for no limit.
+        """
+        self.workers = workers
+        self.priorities = list(capacities.keys())
+        self.capacities = dict(capacities)
+        self.db_concurrency = db_concurrency
+        self.concurrency = {kind: (concurrency or {}).get(kind, 0) for kind in self.priorities}
+        self.queues = {kind: deque() for kind in self.priorities}
+        self.running = {}
+        self.running_kind = {kind: 0 for kind in self.priorities}
+        self.active = 0
+        self.condition = threading.Condition()
+        self.admitted = {kind: 0 for kind in self.priorities}
+        self.rejected = {kind: 0 for kind in self.priorities}
+        self.wait_avg = {kind: 0.0 for kind in self.priorities}
+        self.service_avg = {kind: 0.0 for kind in self.priorities}
+        self.stopped = False
+        self.threads = []
+
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"scheduler_{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+
+    def stop(self, timeout: float = 10) -> None:
+        """
+        Stops the workers once the tasks already admitted are done.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+    def submit(
+        self,
+        kind: str,
+        dbs: List[str],
+        fn: Callable,
+        timings: Optional[Timings] = None
+    ) -> Future:
+        """
+        Queues `fn` in the priority class `kind`.
+        :param dbs: the databases the task works on, counted against the per-database limit.
+        :param timings: if given, records the time the task waited as `queue`.
+        :return: a future resolved with the result of `fn`.
+        """
+        task = _Task(fn, dbs, timings)
+        with self.condition:
+            queue = self.queues[kind]
+            if self.stopped or len(queue) >= self.capacities[kind]:
+                self.rejected[kind] += 1
+                raise Overloaded(f"Too many pending {kind} requests.", self._retry_after(kind))
+            queue.append(task)
+            self.admitted[kind] += 1
+            self.condition.notify()
+        return task.future
+
+
+    def _retry_after(self, kind: str) -> int:
+        """
+        Estimates in seconds how long the queue of `kind` needs to drain. Requires the condition.
+        """
+        pending = sum(len(self.queues[k]) for k in self.priorities[:self.priorities.index(kind) + 1])
+        return max(1, math.ceil(pending * self.service_avg[kind] / max(self.workers, 1)))
+
+
+    def _runnable(self, task: _Task) -> bool:
+        return self.db_concurrency <= 0 or all(self.running.get(db, 0) < self.db_concurrency for db in task.dbs)
+
+
+    def _next_task(self):
+        with self.condition:
+            while True:
+                for kind in self.priorities:
+                    if 0 < self.concurrency[kind] <= self.running_kind[kind]:
+                        continue
+                    queue = self.queues[kind]
+                    for i, task in enumerate(queue):
+                        if self._runnable(task):
+                            del queue[i]
+                            self.active += 1
+                            self.running_kind[kind] += 1
+                            for db in task.dbs:
+                                self.running[db] = self.running.get(db, 0) + 1
+                            return kind, task
+                if self.stopped and all(len(queue) == 0 for queue in self.queues.values()):
+                    return None, None
+                self.condition.wait()
+
+
+    def _run(self) -> None:
+        while True:
+            kind, task = self._next_task()
+            if task is None:
+                return
+
+            started = time.perf_counter()
+            if task.timings is not None:
+                task.timings.record("queue", task.enqueued)
+            if task.future.set_running_or_notify_cancel():
+                try:
+                    task.future.set_result(task.fn())
+                except BaseException as e:
+                    task.future.set_exception(e)
+            finished = time.perf_counter()
+
+            with self.condition:
+                self.active -= 1
+                self.running_kind[kind] -= 1
+                for db in task.dbs:
+                    self.running[db] -= 1
+                    if self.running[db] == 0:
+                        del self.running[db]
+                self.wait_avg[kind] += 0.1 * ((started - task.enqueued) - self.wait_avg[kind])
+                self.service_avg[kind] += 0.1 * ((finished - started) - self.service_avg[kind])
+                self.condition.notify_all()
+
+
+    def status(self) -> dict:
+        """
+        Returns per priority class the queue depth and capacity, the running tasks and their
+        limit, the age of the oldest queued task, the moving average of the queue wait and
+        service time (milliseconds) and the number of admitted and rejected tasks.
+        """
+        now = time.perf_counter()
+        with self.condition:
+            return {
+                "workers": self.workers,
+                "db_concurrency": self.db_concurrency,
+                "running": self.active,
+                "running_per_db": dict(self.running),
+                "queues": {
+                    kind: {
+                        "depth": len(self.queues[kind]),
+                        "capacity": self.capacities[kind],
+                        "running": self.running_kind[kind],
+                        "concurrency": self.concurrency[kind],
+                        "oldest_wait_ms": round((now - self.queues[kind][0].enqueued) * 1000, 3) if len(self.queues[kind]) > 0 else 0.0,
+                        "wait_avg_ms": round(self.wait_avg[kind] * 1000, 3),
+                        "service_avg_ms": round(self.service_avg[kind] * 1000, 3),
+                        "admitted": self.admitted[kind],
+                        "rejected": self.rejected[kind]
+                    }
+                    for kind in self.priorities
+                }
+            }
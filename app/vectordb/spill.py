@@ -0,0 +1,88 @@
+"""
+This module provides the SpillStore class that keeps evicted databases on local disk
+until they are accessed again.
+"""
+
+# pylint: disable = line-too-long, trailing-whitespace, trailing-newlines, line-too-long, missing-module-docstring, import-error, too-few-public-methods, too-many-instance-attributes, too-many-locals
+
+import os
+import time
+import uuid
+import pickle
+import shutil
+import atexit
+import tempfile
+from typing import Tuple
+import numpy as np
+
+
+class SpillEntry:
+    """
+    Describes a database written to disk.
+    """
+
+    def __init__(self, path: str, memory_bytes: int, record_count: int, last_seq: int, generation: int, settings: dict):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.record_count = record_count
+        self.last_seq = last_seq
+        self.generation = generation
+        self.settings = settings
+        self.spilled_at = time.time()
+
+
+class SpillStore:
+    """
+    SpillStore writes a database as two files: the stored vectors as a `.npy` array, which
+    can be memory mapped on reload, and everything else (settings, records, index state)
+    as a pickle. Files live in a private directory removed when the process exits.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix="spill-", dir=directory)
+        atexit.register(shutil.rmtree, self.directory, True)
+
+
+    def write(
+        self,
+        export: dict,
+        vectors: np.ndarray,
+        memory_bytes: int,
+        last_seq: int,
+        generation: int
+    ) -> SpillEntry:
+        """
+        Writes a database to disk.
+        :param export: the settings, records and index state of the database.
+        :param vectors: the vectors stored in its index.
+        :return: the entry needed to read it back.
+        """
+        path = os.path.join(self.directory, uuid.uuid4().hex)
+        os.makedirs(path)
+        np.save(os.path.join(path, "vectors.npy"), vectors)
+        with open(os.path.join(path, "records.pkl"), 'wb') as f:
+            pickle.dump(export, f, protocol=pickle.HIGHEST_PROTOCOL)
+        settings = {k: v for k, v in export.items() if k not in ("memory", "index_state")}
+        return SpillEntry(path, memory_bytes, len(export["memory"]), last_seq, generation, settings)
+
+
+    def read(
+        self,
+        entry: SpillEntry
+    ) -> Tuple[dict, np.ndarray]:
+        """
+        Reads a database back. The vectors are memory mapped rather than loaded, so the
+        caller can copy them into an index without holding a second full copy in memory.
+        """
+        with open(os.path.join(entry.path, "records.pkl"), 'rb') as f:
+            export = pickle.load(f)
+        vectors = np.load(os.path.join(entry.path, "vectors.npy"), mmap_mode='r')
+        return export, vectors
+
+
+    def remove(
+        self,
+        entry: SpillEntry
+    ) -> None:
+        shutil.rmtree(entry.path, ignore_errors=True)